@@ -0,0 +1,138 @@
+import copy
+import io
+import logging
+import threading
+
+import ckan.model as model
+import ckan.plugins.toolkit as plugins_toolkit
+from ckan.lib.base import config
+
+try:
+    # private helpers of ckanext-dcat, see the requirements in the README
+    from ckanext.dcat.logic import _pagination_info, _search_ckan_datasets
+except ImportError:
+    _pagination_info = _search_ckan_datasets = None
+
+from ckanext.datitrentinoit import export
+from ckanext.datitrentinoit.cache import TTLCache
+
+log = logging.getLogger(__name__)
+
+CONFIG_PACKAGE_SHOW_CACHE_TTL = 'ckanext.datitrentinoit.package_show.cache_ttl'
+CONFIG_PACKAGE_SHOW_CACHE_SIZE = 'ckanext.datitrentinoit.package_show.cache_size'
+DEFAULT_PACKAGE_SHOW_CACHE_TTL = 300
+DEFAULT_PACKAGE_SHOW_CACHE_SIZE = 1000
+
+# package_show parameters which are part of the cache key; calls with any other parameter are not cached
+CACHE_KEY_PARAMS = ('use_default_schema', 'include_tracking', 'include_plugin_data')
+
+_package_show_cache = None
+_package_show_cache_lock = threading.Lock()
+
+
+def _get_cache():
+    global _package_show_cache
+    if _package_show_cache is None:
+        with _package_show_cache_lock:
+            if _package_show_cache is None:
+                _package_show_cache = TTLCache(
+                    int(config.get(CONFIG_PACKAGE_SHOW_CACHE_TTL, DEFAULT_PACKAGE_SHOW_CACHE_TTL)),
+                    max_entries=int(config.get(CONFIG_PACKAGE_SHOW_CACHE_SIZE, DEFAULT_PACKAGE_SHOW_CACHE_SIZE)))
+    return _package_show_cache
+
+
+def invalidate_package_show(id_or_name):
+    '''
+    Removes all the cached package_show results of a dataset
+    '''
+    pkg = model.Package.get(id_or_name)
+    package_id = pkg.id if pkg else id_or_name
+    _get_cache().invalidate_if(lambda key: key[0] == package_id)
+
+
+@plugins_toolkit.chained_action
+@plugins_toolkit.side_effect_free
+def package_show(original_action, context, data_dict):
+    '''
+    Caches the result of package_show, keyed by dataset id, metadata_modified
+    and state (plus language and output options), so that datasets
+    which did not change are not dictized and validated again.
+
+    Access is checked on every call. Calls with a custom schema, without
+    validation or with other parameters are not cached.
+    '''
+    if context.get('schema') or context.get('validate') is False or context.get('use_cache') is False or \
+            set(data_dict) - set(CACHE_KEY_PARAMS) - {'id'} or \
+            _get_cache().ttl <= 0:
+        return original_action(context, data_dict)
+
+    pkg = model.Package.get(data_dict.get('id'))
+    if pkg is None:
+        return original_action(context, data_dict)
+
+    context['package'] = pkg
+    plugins_toolkit.check_access('package_show', context, data_dict)
+
+    key = (pkg.id, pkg.metadata_modified.isoformat() if pkg.metadata_modified else None, pkg.state, _get_lang(),
+           bool(context.get('for_view'))) + tuple(str(data_dict.get(param)) for param in CACHE_KEY_PARAMS)
+
+    cache = _get_cache()
+    package_dict = cache.get(key)
+    if package_dict is None:
+        package_dict = original_action(context, data_dict)
+        cache.set(key, copy.deepcopy(package_dict))
+        return package_dict
+
+    return copy.deepcopy(package_dict)
+
+
+@plugins_toolkit.chained_action
+@plugins_toolkit.side_effect_free
+def dcat_dataset_show(original_action, context, data_dict):
+    '''
+    Serializes the dataset from its cached RDF fragment, when the format
+    allows it and ckanext.datitrentinoit.rdf_cache.dir is configured.
+    '''
+    cache = export.get_fragment_cache(_get_lang())
+    if cache is None or data_dict.get('format') not in export.EXPORT_FORMATS or data_dict.get('profiles'):
+        return original_action(context, data_dict)
+
+    plugins_toolkit.check_access('dcat_dataset_show', context, data_dict)
+    dataset_dict = plugins_toolkit.get_action('package_show')(context, data_dict)
+
+    out = io.BytesIO()
+    export.CatalogStreamer(out, _format=data_dict['format'], cache=cache).write_dataset(dataset_dict)
+    return out.getvalue().decode('utf-8')
+
+
+@plugins_toolkit.chained_action
+@plugins_toolkit.side_effect_free
+def dcat_catalog_show(original_action, context, data_dict):
+    '''
+    Stitches the catalogue page together from the cached RDF fragments of
+    its datasets, so that only the datasets changed since they were last
+    serialized run through the profiles.
+    '''
+    cache = export.get_fragment_cache(_get_lang())
+    if cache is None or data_dict.get('format') not in export.EXPORT_FORMATS or data_dict.get('profiles') or \
+            _search_ckan_datasets is None:
+        return original_action(context, data_dict)
+
+    plugins_toolkit.check_access('dcat_catalog_show', context, data_dict)
+    query = _search_ckan_datasets(context, data_dict)
+
+    out = io.BytesIO()
+    streamer = export.CatalogStreamer(out, _format=data_dict['format'], cache=cache)
+    streamer.write_catalog()
+    for dataset_dict in query['results']:
+        streamer.write_dataset(dataset_dict)
+    streamer.write_pagination(_pagination_info(query, data_dict))
+    return out.getvalue().decode('utf-8')
+
+
+def _get_lang():
+    # plugins may localize the dataset on show
+    try:
+        return plugins_toolkit.h.lang()
+    except (RuntimeError, TypeError, AttributeError):
+        return None
@@ -4,14 +4,18 @@
 
 $(function(){
   var feed_container = $('#latest-changes');
+  var feed_url = feed_container.data('url');
+  if (!feed_url) {
+    return;
+  }
 
-  $.ajax({type:'GET', url:'/dataset?q=&sort=metadata_modified+desc'})
+  $.ajax({type:'GET', url:feed_url, dataType:'html'})
     .done(function(data){
       feed_container.css({
         'padding': '10px',
         'overflow': 'auto',
         'height': '210px',
       });
-      feed_container.html($(data).find('.dataset-list'));
+      feed_container.html(data);
     });
 });
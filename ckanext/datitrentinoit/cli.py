@@ -0,0 +1,306 @@
+import datetime
+import json
+import logging
+import time
+
+import click
+
+import ckan.model as model
+import ckan.plugins.toolkit as plugins_toolkit
+
+import ckanext.datitrentinoit.export as export
+import ckanext.datitrentinoit.harvesters.maintenance as maintenance
+import ckanext.datitrentinoit.harvesters.dryrun as dryrun
+import ckanext.datitrentinoit.model.mapping as mapping
+from ckanext.datitrentinoit.harvesters.runner import InProcessRunner
+
+log = logging.getLogger(__name__)
+
+
+def get_commands():
+    return [datitrentinoit]
+
+
+@click.group()
+def datitrentinoit():
+    '''dati.trentino.it management commands.
+    '''
+    pass
+
+
+@datitrentinoit.group()
+def statweb():
+    '''Maintenance of the StatWeb harvest sources.
+    '''
+    pass
+
+
+@statweb.command('create-indexes')
+@click.option('--concurrently', is_flag=True,
+              help='Build the indexes without locking the tables against writes')
+def create_indexes(concurrently):
+    '''Creates the DB indexes used by the StatWeb harvesters current-object lookups.
+    '''
+    for name in maintenance.create_harvest_object_indexes(concurrently=concurrently):
+        click.echo(f'Index {name} ready')
+    click.secho('Indexes created', fg='green')
+
+
+@statweb.command('compact-objects')
+@click.option('--source', 'source_id_or_name', default=None,
+              help='Harvest source id or name (default: all the StatWeb sources)')
+@click.option('--keep', default=2, show_default=True,
+              help='Number of most recent objects to keep for each guid')
+@click.option('--retention-days', default=30, show_default=True,
+              help='Only objects older than this are removed')
+@click.option('--batch-size', default=1000, show_default=True,
+              help='Number of objects deleted in each transaction')
+@click.option('--archive', type=click.File('a', encoding='utf-8'), default=None,
+              help='Append the deleted objects to this file as JSON lines')
+@click.option('--dry-run', is_flag=True, help='Only count the objects to be removed')
+def compact_objects(source_id_or_name, keep, retention_days, batch_size, archive, dry_run):
+    '''Removes the superseded harvest objects of the StatWeb sources.
+
+    Objects are deleted in batches, each one in its own transaction, so that
+    an interrupted run can be resumed by running the command again.
+    '''
+    if keep < 1:
+        raise click.BadParameter('at least one object per guid must be kept', param_hint='--keep')
+
+    try:
+        sources = maintenance.get_statweb_sources(source_id_or_name)
+    except ValueError as e:
+        plugins_toolkit.error_shout(e)
+        raise click.Abort()
+
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=retention_days)
+
+    total_deleted = 0
+    for source in sources:
+        count = maintenance.count_superseded_objects(source.id, keep, cutoff)
+        click.echo(f'Source {source.id} ({source.type}): {count} superseded objects')
+        if dry_run or not count:
+            continue
+
+        with click.progressbar(length=count, label='Compacting') as bar:
+            for deleted in maintenance.compact_harvest_objects(source.id, keep, cutoff,
+                                                               batch_size=batch_size, archive=archive):
+                bar.update(deleted)
+                total_deleted += deleted
+
+    click.secho(f'Removed {total_deleted} harvest objects', fg='green')
+
+
+@statweb.command('run')
+@click.argument('source_id_or_name')
+@click.option('--fetch-workers', default=4, show_default=True, help='Number of fetch threads')
+@click.option('--import-workers', default=1, show_default=True, help='Number of import threads')
+@click.option('--queue-size', default=100, show_default=True,
+              help='Max number of objects waiting between two stages')
+@click.option('--report-interval', default=5, show_default=True,
+              help='Seconds between two throughput reports')
+@click.pass_context
+def run(ctx, source_id_or_name, fetch_workers, import_workers, queue_size, report_interval):
+    '''Harvests a StatWeb source in this process, bypassing the harvest queues.
+
+    Meant for backfills and recovery: gather, fetch and import run as a
+    pipeline of thread pools, and the job is finalized at the end, even if
+    the run fails or is interrupted.
+    '''
+    from ckanext.harvest.logic import HarvestJobExists
+    from ckanext.harvest.model import HarvestJob
+    import ckanext.harvest.queue as harvest_queue
+
+    try:
+        source = maintenance.get_statweb_sources(source_id_or_name)[0]
+    except ValueError as e:
+        plugins_toolkit.error_shout(e)
+        raise click.Abort()
+
+    harvester = harvest_queue.get_harvester(source.type)
+    if harvester is None:
+        plugins_toolkit.error_shout(f'Harvester plugin not loaded for source type {source.type}')
+        raise click.Abort()
+
+    flask_app = ctx.meta['flask_app']
+    site_user = plugins_toolkit.get_action('get_site_user')({'model': model, 'ignore_auth': True}, {})
+    context = {'model': model, 'session': model.Session, 'user': site_user['name']}
+
+    with flask_app.test_request_context():
+        try:
+            job_dict = plugins_toolkit.get_action('harvest_job_create')(context, {'source_id': source.id})
+        except HarvestJobExists:
+            plugins_toolkit.error_shout(f'Source {source_id_or_name} already has a pending or running job')
+            raise click.Abort()
+        job = HarvestJob.get(job_dict['id'])
+        job.status = 'Running'
+        job.save()
+
+        def report(stats):
+            click.echo(f'\r{stats.summary()}', nl=False)
+
+        runner = InProcessRunner(harvester, job,
+                                 fetch_workers=fetch_workers,
+                                 import_workers=import_workers,
+                                 queue_size=queue_size,
+                                 context_factory=flask_app.test_request_context,
+                                 report=report,
+                                 report_interval=report_interval)
+        interrupted = True
+        try:
+            stats = runner.run()
+            interrupted = False
+        finally:
+            click.echo('')
+            # error the objects left pending (e.g. on Ctrl-C), then mark the
+            # job as finished and update the source stats
+            runner.finalize(interrupted)
+            plugins_toolkit.get_action('harvest_jobs_run')(context, {'source_id': source.id})
+
+    click.secho(f'Job {job_dict["id"]} completed: {stats.summary()}', fg='green')
+
+
+@statweb.command('diff')
+@click.argument('source_id_or_name')
+@click.option('--resources', is_flag=True,
+              help='Also download the indicator tables and compare the resources')
+@click.option('--workers', default=4, show_default=True, help='Number of parallel downloads')
+@click.option('--max-length', default=80, show_default=True,
+              help='Max length of the values shown in the field diffs (0: no limit)')
+@click.option('--output', type=click.File('w', encoding='utf-8'), default=None,
+              help='Write the full report to this file as JSON')
+@click.pass_context
+def diff(ctx, source_id_or_name, resources, workers, max_length, output):
+    '''Shows what a harvest of a StatWeb source would change, without writing anything.
+
+    The service is downloaded and mapped as in a real harvest, and compared
+    with the stored datasets: new, changed, deleted and unchanged entries are
+    reported, with the field level differences of the changed ones.
+    '''
+    import ckanext.harvest.queue as harvest_queue
+
+    try:
+        source = maintenance.get_statweb_sources(source_id_or_name)[0]
+    except ValueError as e:
+        plugins_toolkit.error_shout(e)
+        raise click.Abort()
+
+    harvester = harvest_queue.get_harvester(source.type)
+    if harvester is None:
+        plugins_toolkit.error_shout(f'Harvester plugin not loaded for source type {source.type}')
+        raise click.Abort()
+
+    def shorten(value):
+        value = value if isinstance(value, str) else json.dumps(value)
+        value = value.replace('\n', ' ')
+        return value if not max_length or len(value) <= max_length else value[:max_length - 3] + '...'
+
+    compared = 0
+
+    def progress(count):
+        nonlocal compared
+        compared += count
+        click.echo(f'\rCompared {compared} entries', nl=False)
+
+    with ctx.meta['flask_app'].test_request_context():
+        report = dryrun.dry_run(harvester, source, resources=resources, workers=workers, progress=progress)
+    click.echo('')
+
+    for guid in report.new:
+        click.secho(f'+ {guid}', fg='green')
+    for guid in report.deleted:
+        click.secho(f'- {guid} ({report.package_ids[guid]})', fg='red')
+    for guid, diffs in sorted(report.changed.items()):
+        click.secho(f'~ {guid} ({report.package_ids[guid]})', fg='yellow')
+        for field, (old, new) in sorted(diffs.items()):
+            click.echo(f'    {field}: {shorten(old)} -> {shorten(new)}')
+    for guid, error in sorted(report.errors.items()):
+        click.secho(f'! {guid}: {error}', fg='red')
+
+    if output:
+        json.dump(report.as_dict(), output, indent=2, default=str)
+
+    click.secho(f'Source {source.id} ({source.type}): {report.summary()}', fg='green')
+
+
+@datitrentinoit.group()
+def frequencies():
+    '''Frequency labels used by the StatWeb harvesters.
+    '''
+    pass
+
+
+@frequencies.command('reload')
+def reload_frequencies():
+    '''Reloads the frequency labels from the dcatapit vocabulary.
+
+    To be run after the vocabulary has been loaded or updated (e.g. with
+    "ckan dcatapit load"): the running web and harvest processes reload it
+    within a minute.
+    '''
+    mapping.invalidate_frequencies()
+    click.secho('Frequencies mapping invalidated', fg='green')
+
+
+@frequencies.command('migration-sql')
+def frequencies_migration_sql():
+    '''Prints the SQL replacing the legacy frequency labels with the dcatapit codes.
+    '''
+    for statement in mapping.frequency_migration_sql():
+        click.echo(statement)
+
+
+@datitrentinoit.group()
+def dcat():
+    '''DCAT-AP_IT catalogue export.
+    '''
+    pass
+
+
+@dcat.command('export')
+@click.option('--output', type=click.File('wb'), default='-', show_default=True,
+              help='File the catalogue is written to')
+@click.option('--format', '_format', type=click.Choice(sorted(export.EXPORT_FORMATS)), default='nt',
+              show_default=True, help='RDF serialization')
+@click.option('--fq', default=None, help='Solr filter query selecting the datasets to export')
+@click.option('--batch-size', default=100, show_default=True,
+              help='Number of datasets fetched from the search index at a time')
+@click.option('--no-cache', is_flag=True, default=False,
+              help='Do not use the RDF fragments cached in ckanext.datitrentinoit.rdf_cache.dir')
+@click.option('--processes', type=click.IntRange(min=0), default=1, show_default=True,
+              help='Number of processes running the profiles, 0 for one per CPU')
+def export_catalog(output, _format, fq, batch_size, no_cache, processes):
+    '''Exports the DCAT catalogue, serializing one dataset at a time.
+
+    The datasets run through the profiles configured in
+    ckanext.dcat.rdf.profiles, each one on its own graph, so memory usage
+    does not grow with the size of the catalogue. Datasets which did not
+    change since the last export are read from the RDF fragment cache.
+
+    With --processes the pages of --batch-size datasets are run through the
+    profiles in a pool of processes, and merged in order into the output.
+    '''
+    started = time.monotonic()
+    total = export.count_datasets(fq)
+    cache = None if no_cache else export.get_fragment_cache()
+    streamer = export.CatalogStreamer(output, _format=_format, cache=cache)
+    streamer.write_catalog()
+
+    errors = 0
+    with click.progressbar(length=total, label='Exporting', file=click.get_text_stream('stderr')) as bar:
+        if processes != 1:
+            errors = export.write_datasets_parallel(streamer, fq, batch_size=batch_size, processes=processes or None,
+                                                    use_cache=cache is not None, progress=bar.update)
+        else:
+            for dataset_dict in export.iter_datasets(fq, batch_size=batch_size):
+                try:
+                    streamer.write_dataset(dataset_dict)
+                except Exception:
+                    log.exception('Error exporting dataset %s', dataset_dict.get('name'))
+                    errors += 1
+                bar.update(1)
+
+    elapsed = time.monotonic() - started
+    click.secho(f'Exported {streamer.datasets} datasets ({streamer.cache_hits} from cache, {errors} errors) '
+                f'in {elapsed:.1f}s ({streamer.datasets / elapsed if elapsed else 0:.1f} datasets/s)',
+                fg='green', err=True)
@@ -0,0 +1,340 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import tempfile
+
+import pkg_resources
+from rdflib import BNode, Graph, URIRef
+
+import ckan.model as model
+import ckan.plugins.toolkit as plugins_toolkit
+from ckan.lib.base import config
+
+from ckanext.dcat.processors import RDFSerializer
+from ckanext.dcat.profiles import DCAT
+
+from ckanext.datitrentinoit.profile import PROFILE_VERSION
+
+log = logging.getLogger(__name__)
+
+CONFIG_RDF_CACHE_DIR = 'ckanext.datitrentinoit.rdf_cache.dir'
+
+# formats whose documents can be concatenated: name: rdflib format
+EXPORT_FORMATS = {
+    'nt': 'nt',
+    'ttl': 'turtle',
+    'turtle': 'turtle',
+}
+
+# distributions whose version is part of the profile version
+PROFILE_DISTRIBUTIONS = ('ckanext-dcat', 'ckanext-dcatapit', 'ckanext-datitrentinoit')
+
+_FRAGMENT_DATASET = b'# dataset '
+_FRAGMENT_SHARED = b'# shared'
+
+
+class CatalogStreamer(object):
+    '''
+    Serializes a DCAT catalogue one dataset at a time.
+
+    Each dataset is run through the configured profiles on its own graph,
+    which is serialized to `out` and discarded, so memory does not grow with
+    the size of the catalogue. Triples about nodes shared among the
+    datasets (e.g. contact points, publishers, licenses) are only written the
+    first time.
+
+    If a FragmentCache is given, the serialized triples of each dataset are
+    reused as long as the dataset and the profiles do not change.
+    '''
+
+    def __init__(self, out, _format='nt', profiles=None, cache=None):
+        if _format not in EXPORT_FORMATS:
+            raise ValueError(f'Unsupported format for a streamed catalogue: {_format}')
+        self.out = out
+        self.format = EXPORT_FORMATS[_format]
+        self.cache = cache
+        self.profiles = profiles
+        self.serializer = RDFSerializer(profiles=profiles)
+        # the namespaces bound by the serializer, for the per dataset graphs
+        self._namespaces = list(self.serializer.g.namespaces())
+        self.catalog_ref = None
+        self.datasets = 0
+        self.cache_hits = 0
+        self._shared_lines = set()
+
+    def write_catalog(self, catalog_dict=None):
+        self.serializer.g = self._new_graph()
+        self.catalog_ref = self.serializer.graph_from_catalog(catalog_dict)
+        own, shared = _split_lines(self.serializer.g, {self.catalog_ref})
+        self._write(own, shared)
+
+    def write_dataset(self, dataset_dict):
+        self.write_fragment(self.get_fragment(dataset_dict))
+
+    def get_fragment(self, dataset_dict):
+        '''
+        :return: the fragment of the dataset from the cache, or built and cached
+        '''
+        fragment = self.cache.get(dataset_dict) if self.cache else None
+        if fragment is not None:
+            self.cache_hits += 1
+        else:
+            fragment = self.build_fragment(dataset_dict)
+            if self.cache:
+                self.cache.set(dataset_dict, *fragment)
+        return fragment
+
+    def write_fragment(self, fragment):
+        dataset_uri, own, shared = fragment
+        if self.catalog_ref is not None:
+            own = own + [_nt_line(self.catalog_ref, DCAT.dataset, URIRef(dataset_uri))]
+        self._write(own, shared)
+        self.datasets += 1
+
+    def write_pagination(self, pagination_info):
+        self.serializer.g = self._new_graph()
+        self.serializer._add_pagination_triples(pagination_info)
+        self._write(_nt_lines(self.serializer.g), [])
+
+    def build_fragment(self, dataset_dict):
+        '''
+        Runs the dataset through the profiles
+
+        :return: the dataset URI, the N-Triples lines describing the dataset
+                 and its distributions, and the ones describing shared nodes
+        '''
+        g = self.serializer.g = self._new_graph()
+        dataset_ref = self.serializer.graph_from_dataset(dataset_dict)
+        own_subjects = {dataset_ref}
+        own_subjects.update(g.objects(dataset_ref, DCAT.distribution))
+        own, shared = _split_lines(g, own_subjects)
+        return str(dataset_ref), own, shared
+
+    def _new_graph(self):
+        g = Graph()
+        for prefix, namespace in self._namespaces:
+            g.bind(prefix, namespace)
+        return g
+
+    def _write(self, own, shared):
+        # nodes described by several datasets are only written once
+        lines = list(own)
+        for line in shared:
+            if line not in self._shared_lines:
+                self._shared_lines.add(line)
+                lines.append(line)
+        data = b'\n'.join(lines) + b'\n'
+
+        if self.format != 'nt':
+            g = self._new_graph()
+            g.parse(data=data.decode('utf-8'), format='nt')
+            data = g.serialize(format=self.format)
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+        self.out.write(data)
+
+
+class FragmentCache(object):
+    '''
+    Stores the serialized triples of each dataset in `basedir`, keyed by
+    dataset id, metadata_modified, profile version and language, since
+    plugins may localize the dataset dicts of web requests.
+    '''
+
+    def __init__(self, basedir, version, lang=None):
+        self.basedir = basedir
+        self.version = version
+        self.lang = lang
+
+    def get(self, dataset_dict):
+        '''
+        :return: (dataset uri, own lines, shared lines) or None
+        '''
+        try:
+            with open(self._path(dataset_dict), 'rb') as f:
+                lines = f.read().splitlines()
+        except IOError:
+            return None
+        if not lines or not lines[0].startswith(_FRAGMENT_DATASET) or _FRAGMENT_SHARED not in lines:
+            return None
+        split = lines.index(_FRAGMENT_SHARED)
+        return lines[0][len(_FRAGMENT_DATASET):].decode('utf-8'), lines[1:split], lines[split + 1:]
+
+    def set(self, dataset_dict, dataset_uri, own, shared):
+        path = self._path(dataset_dict)
+        dataset_dir = os.path.dirname(path)
+        os.makedirs(dataset_dir, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=dataset_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(b'\n'.join([_FRAGMENT_DATASET + dataset_uri.encode('utf-8')] + own + [_FRAGMENT_SHARED] + shared))
+        os.replace(tmp_path, path)
+
+        # remove the fragments of the previous versions of the dataset in the same
+        # language, and the ones stored without a language by older versions
+        prefix = self._prefix()
+        for name in os.listdir(dataset_dir):
+            if name != os.path.basename(path) and name.endswith('.nt') and \
+                    (name.startswith(prefix) or name.count('.') == 1):
+                os.remove(os.path.join(dataset_dir, name))
+
+    def _prefix(self):
+        return '{0}.'.format(self.lang or '_')
+
+    def _path(self, dataset_dict):
+        key = hashlib.sha1('{0}|{1}'.format(dataset_dict.get('metadata_modified'), self.version).encode())
+        dataset_id = dataset_dict['id']
+        return os.path.join(self.basedir, dataset_id[:2], dataset_id, self._prefix() + key.hexdigest() + '.nt')
+
+
+def get_fragment_cache(lang=None):
+    '''
+    :param lang: the language of the dataset dicts, if they may be localized
+    :return: the FragmentCache in `ckanext.datitrentinoit.rdf_cache.dir`, or None if not configured
+    '''
+    basedir = config.get(CONFIG_RDF_CACHE_DIR)
+    return FragmentCache(basedir, profile_version(), lang) if basedir else None
+
+
+def profile_version():
+    '''
+    :return: a digest of the configured profiles and of the versions of the
+             extensions implementing them
+    '''
+    parts = [config.get('ckanext.dcat.rdf.profiles', ''), PROFILE_VERSION]
+    for name in PROFILE_DISTRIBUTIONS:
+        try:
+            parts.append(pkg_resources.get_distribution(name).version)
+        except pkg_resources.DistributionNotFound:
+            parts.append('')
+    return hashlib.sha1('|'.join(parts).encode()).hexdigest()
+
+
+def _split_lines(g, own_subjects):
+    '''
+    :return: the N-Triples lines of the triples about own subjects (and blank
+             nodes), and the ones about other, possibly shared, subjects
+    '''
+    own, shared = Graph(), Graph()
+    for triple in g:
+        subject = triple[0]
+        if subject in own_subjects or isinstance(subject, BNode):
+            own.add(triple)
+        else:
+            shared.add(triple)
+    return _nt_lines(own), _nt_lines(shared)
+
+
+def _nt_lines(g):
+    data = g.serialize(format='nt')
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return [line for line in data.splitlines() if line.strip()]
+
+
+def _nt_line(s, p, o):
+    return f'{s.n3()} {p.n3()} {o.n3()} .'.encode('utf-8')
+
+
+def write_datasets_parallel(streamer, fq=None, batch_size=100, processes=None, use_cache=True, progress=None):
+    '''
+    Builds the fragments of the datasets in a pool of processes and writes
+    them with `streamer`, in the same order as iter_datasets.
+
+    The dataset list is partitioned in pages of `batch_size` datasets: each
+    worker fetches a page from the search index and runs its datasets
+    through the profiles, the main process writes the fragments out, so
+    that the shared nodes are still written once.
+
+    Workers are forked, inheriting the loaded CKAN configuration and plugins.
+
+    :param progress: callable receiving the number of datasets processed, for each page
+    :return: the number of datasets which could not be exported
+    '''
+    total = count_datasets(fq)
+    pages = [(fq, start, batch_size) for start in range(0, total, batch_size)]
+    errors = 0
+
+    # close the DB connections before forking, so that the workers do not inherit them
+    model.Session.remove()
+    model.meta.engine.dispose()
+    pool = multiprocessing.get_context('fork').Pool(
+        processes, initializer=_init_worker, initargs=(streamer.profiles, use_cache))
+    try:
+        for fragments, page_errors, cache_hits in pool.imap(_build_page_fragments, pages):
+            for fragment in fragments:
+                streamer.write_fragment(fragment)
+            streamer.cache_hits += cache_hits
+            errors += page_errors
+            if progress:
+                progress(len(fragments) + page_errors)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return errors
+
+
+_worker_streamer = None
+
+
+def _init_worker(profiles, use_cache):
+    global _worker_streamer
+    # drop the pool inherited from the parent without closing its connections,
+    # whose sockets would be shared with the parent
+    engine = model.meta.engine
+    try:
+        engine.dispose(close=False)
+    except TypeError:
+        # SQLAlchemy < 1.4.33
+        engine.pool = engine.pool.recreate()
+    _worker_streamer = CatalogStreamer(None, profiles=profiles, cache=get_fragment_cache() if use_cache else None)
+
+
+def _build_page_fragments(page):
+    fq, start, rows = page
+    fragments = []
+    errors = 0
+    cache_hits = _worker_streamer.cache_hits
+    for dataset_dict in _search_datasets(fq, start, rows)['results']:
+        try:
+            fragments.append(_worker_streamer.get_fragment(dataset_dict))
+        except Exception:
+            log.exception('Error exporting dataset %s', dataset_dict.get('name'))
+            errors += 1
+    return fragments, errors, _worker_streamer.cache_hits - cache_hits
+
+
+def iter_datasets(fq=None, batch_size=100):
+    '''
+    Yields the dicts of the public datasets, fetching them from the search
+    index in batches
+    '''
+    start = 0
+    while True:
+        result = _search_datasets(fq, start, batch_size)
+        datasets = result['results']
+        if not datasets:
+            return
+        for dataset_dict in datasets:
+            yield dataset_dict
+        start += len(datasets)
+        if start >= result['count']:
+            return
+
+
+def _search_datasets(fq, start, rows):
+    context = {'model': model, 'session': model.Session, 'ignore_auth': True}
+    return plugins_toolkit.get_action('package_search')(context, {
+        'q': '*:*',
+        'fq': fq or '',
+        'sort': 'id asc',
+        'start': start,
+        'rows': rows,
+    })
+
+
+def count_datasets(fq=None):
+    context = {'model': model, 'session': model.Session, 'ignore_auth': True}
+    return plugins_toolkit.get_action('package_search')(context, {'q': '*:*', 'fq': fq or '', 'rows': 0})['count']
@@ -0,0 +1,375 @@
+import csv
+import io
+import itertools
+import logging
+import re
+import threading
+import time
+import urllib.request as r
+from urllib.error import HTTPError
+
+from ckan.lib.base import config
+from ckan import plugins as p
+
+from ckanext.datastore.backend.postgres import get_write_engine, identifier
+
+from ckanext.datitrentinoit.harvesters.fetcher import fetch, FetchSkipped, DEFAULT_FETCH_TIMEOUT, \
+    CONFIG_FETCH_TIMEOUT
+from ckanext.datitrentinoit.harvesters.throttle import get_throttle, get_circuit_breaker, parse_retry_after, \
+    CircuitOpenError, HostBlockedError
+from ckanext.datitrentinoit.model.statweb_metadata import _safe_decode
+
+log = logging.getLogger(__name__)
+
+CONFIG_DATASTORE_CHUNK_ROWS = 'ckanext.datitrentinoit.datastore.chunk_rows'
+DEFAULT_DATASTORE_CHUNK_ROWS = 5000
+# rows read before creating the table, to infer the column types
+SAMPLE_ROWS = 1000
+# the digest of the loaded content is kept in the comment of the datastore table
+DIGEST_COMMENT_PREFIX = 'statweb:'
+
+# datastore type: postgres data_type, as listed in information_schema
+PG_TYPES = {
+    'int8': 'bigint',
+    'numeric': 'numeric',
+    'text': 'text',
+}
+# column types, from the narrowest to the widest
+WIDENING = ('int8', 'numeric', 'text')
+
+_INT_RE = re.compile(r'^[+-]?\d+$')
+_NUMERIC_RE = re.compile(r'^[+-]?(\d+([.,]\d*)?|[.,]\d+)([eE][+-]?\d+)?$')
+
+
+class ColumnTypesMismatch(Exception):
+    '''
+    Raised when some values do not fit the column types inferred from the
+    first rows; `types` are the types fitting all the values.
+    '''
+
+    def __init__(self, types):
+        super().__init__(f'Column types do not fit the values, widened to {types}')
+        self.types = types
+
+
+class DatastoreLoader(object):
+    '''
+    Loads StatWeb indicator tables into the CKAN datastore.
+
+    CSV resources are streamed from their URL, JSON resources are read from
+    the table the harvester already downloaded. Rows are written with
+    PostgreSQL COPY in chunks of `chunk_rows`, in the same transaction that
+    deletes the previous rows (and replaces the columns, if they changed):
+    a failed load leaves the previous table in place. The previous rows stay
+    visible to the readers until the load is committed, unless the columns
+    changed, in which case the table is locked until then.
+    The column types are inferred from the first rows; if a later value does
+    not fit its column, the column is widened (int8, numeric, text) and the
+    table is loaded again.
+
+    The digest of the loaded content is stored with the table, and the load
+    is skipped when it has not changed.
+    '''
+
+    def __init__(self, chunk_rows=DEFAULT_DATASTORE_CHUNK_ROWS, timeout=DEFAULT_FETCH_TIMEOUT):
+        self.chunk_rows = chunk_rows
+        self.timeout = timeout
+
+    def load(self, context, resource, digest):
+        '''
+        :param resource: the resource dict
+        :param digest: the digest of the upstream content
+
+        :return: the number of loaded rows, or None if the datastore table is already current
+        '''
+        resource_id = resource['id']
+        if self.loaded_digest(resource_id) == digest:
+            log.debug('Datastore table for %s is current, skipping', resource['url'])
+            return None
+
+        # types only get wider at each attempt, so this ends at the latest with all text columns
+        types = None
+        while True:
+            try:
+                return self._load(context, resource, digest, types)
+            except ColumnTypesMismatch as e:
+                log.info('Datastore table %s: values not fitting the inferred column types, reloading as %s',
+                         resource_id, e.types)
+                types = e.types
+
+    def _load(self, context, resource, digest, types=None):
+        if (resource.get('format') or '').lower() == 'csv':
+            response = self._open(resource['url'])
+            try:
+                header, rows = _csv_rows(response)
+                return self._load_rows(context, resource['id'], header, rows, digest, types)
+            finally:
+                response.close()
+
+        header, rows = _json_rows(_safe_decode(fetch(resource['url'])))
+        return self._load_rows(context, resource['id'], header, rows, digest, types)
+
+    def loaded_digest(self, resource_id):
+        '''
+        :return: the digest of the content loaded in the datastore table of the resource, or None
+        '''
+        with get_write_engine().connect() as conn:
+            comment = conn.execute("SELECT obj_description(to_regclass(%s), 'pg_class')",
+                                   identifier(resource_id)).scalar()
+        if comment and comment.startswith(DIGEST_COMMENT_PREFIX):
+            return comment[len(DIGEST_COMMENT_PREFIX):]
+        return None
+
+    def _load_rows(self, context, resource_id, header, rows, digest, types=None):
+        '''
+        :param types: the column types, at least as wide as the ones inferred from the first rows
+        :raise ColumnTypesMismatch: if some values do not fit the column types, once all the rows have been read
+        '''
+        columns = _column_names(header)
+        rows = _fit(rows, len(columns))
+        sample = list(itertools.islice(rows, SAMPLE_ROWS))
+        inferred = [_infer_type(row[i] for row in sample) for i in range(len(columns))]
+        types = [_wider(t, i) for t, i in zip(types, inferred)] if types and len(types) == len(columns) \
+            else inferred
+        table = identifier(resource_id)
+        column_list = ', '.join(identifier(c) for c in columns)
+        copy_sql = f'COPY {table} ({column_list}) FROM STDIN WITH (FORMAT csv)'
+        coercers = [_COERCERS[t] for t in types]
+
+        loaded = 0
+        widened = None
+        conn = get_write_engine().raw_connection()
+        try:
+            cursor = conn.cursor()
+            self._prepare_table(context, cursor, resource_id, columns, types)
+            for chunk in _chunks(itertools.chain(sample, rows), self.chunk_rows):
+                buf = io.StringIO()
+                writer = csv.writer(buf)
+                for row in chunk:
+                    values = [coerce(value) for coerce, value in zip(coercers, row)]
+                    for i, (value, orig) in enumerate(zip(values, row)):
+                        if value is None and orig not in (None, ''):
+                            # keep reading, to widen all the columns at once
+                            widened = widened or list(types)
+                            widened[i] = _fitting_type(orig, widened[i])
+                    if widened is None:
+                        writer.writerow(values)
+                if widened is None:
+                    buf.seek(0)
+                    cursor.copy_expert(copy_sql, buf)
+                    loaded += len(chunk)
+
+            if widened is not None:
+                raise ColumnTypesMismatch(widened)
+
+            # COPY bypasses the datastore upsert, which fills the full text column
+            text_columns = ', '.join(f'{identifier(c)}::text' for c in columns).replace('%', '%%')
+            cursor.execute(f"UPDATE {table} SET _full_text = to_tsvector(%s, concat_ws(' ', {text_columns}))",
+                           (config.get('ckan.datastore.default_fts_lang', 'english'),))
+            cursor.execute(f'COMMENT ON TABLE {table} IS %s', (DIGEST_COMMENT_PREFIX + digest,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        log.info('Loaded %d rows in the datastore table %s', loaded, resource_id)
+        return loaded
+
+    def _prepare_table(self, context, cursor, resource_id, columns, types):
+        '''
+        Creates the datastore table, or deletes its rows and replaces its
+        columns if they changed, in the transaction of `cursor`
+        '''
+        cursor.execute(
+            "SELECT column_name, data_type FROM information_schema.columns "
+            "WHERE table_schema = current_schema() AND table_name = %s AND column_name NOT LIKE '\\_%%' "
+            "ORDER BY ordinal_position", (resource_id,))
+        existing = [tuple(row) for row in cursor.fetchall()]
+
+        if not existing:
+            # a new table, there is no previous content to keep
+            p.toolkit.get_action('datastore_create')(context.copy(), {
+                'resource_id': resource_id,
+                'force': True,
+                'fields': [{'id': c, 'type': t} for c, t in zip(columns, types)],
+            })
+            return
+
+        table = identifier(resource_id)
+        # unlike TRUNCATE, DELETE does not lock the table for the readers
+        cursor.execute(f'DELETE FROM {table}')
+        if existing != [(c, PG_TYPES[t]) for c, t in zip(columns, types)]:
+            log.info('Columns of the datastore table %s changed, replacing them', resource_id)
+            changes = [f'DROP COLUMN {identifier(name)}' for name, _ in existing]
+            changes.extend(f'ADD COLUMN {identifier(c)} {t}' for c, t in zip(columns, types))
+            cursor.execute(f'ALTER TABLE {table} ' + ', '.join(changes))
+
+    def _open(self, url):
+        '''
+        Opens a streaming download of the URL within the limits of the throttle of its host
+        '''
+        throttle = get_throttle(url)
+        breaker = get_circuit_breaker(url)
+        try:
+            breaker.check()
+        except CircuitOpenError as e:
+            raise FetchSkipped(str(e))
+
+        try:
+            throttle.acquire()
+        except HostBlockedError as e:
+            breaker.cancel()
+            raise FetchSkipped(str(e))
+        start = time.monotonic()
+        try:
+            response = r.urlopen(url, timeout=self.timeout)
+        except HTTPError as e:
+            server_error = e.code >= 500 or e.code == 429
+            retry_after = parse_retry_after(e.headers.get('Retry-After')) if e.headers else None
+            throttle.release(time.monotonic() - start, error=server_error, retry_after=retry_after)
+            if server_error:
+                breaker.failure()
+            else:
+                breaker.success()
+            raise
+        except Exception:
+            throttle.release(time.monotonic() - start, error=True)
+            breaker.failure()
+            raise
+        throttle.release(time.monotonic() - start)
+        breaker.success()
+        return response
+
+
+def _csv_rows(response):
+    '''
+    :return: the header and an iterator over the rows of a streamed CSV file
+    '''
+    text = io.TextIOWrapper(response, encoding='utf-8-sig', errors='replace', newline='')
+    head = list(itertools.islice(text, 50))
+    try:
+        dialect = csv.Sniffer().sniff(''.join(head), delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.reader(itertools.chain(head, text), dialect)
+    header = next(reader, None)
+    if not header:
+        raise ValueError('Empty CSV file')
+    return header, reader
+
+
+def _json_rows(obj):
+    '''
+    :return: the header and an iterator over the rows of a StatWeb JSON table ({title: [{column: value}]})
+    '''
+    if not isinstance(obj, dict) or len(obj) != 1:
+        raise ValueError('Not a StatWeb table')
+    rows = [row for row in next(iter(obj.values())) or [] if isinstance(row, dict)]
+    header = []
+    for row in rows[:SAMPLE_ROWS]:
+        header.extend(key for key in row if key not in header)
+    if not header:
+        raise ValueError('Empty table')
+    return header, ([row.get(key) for key in header] for row in rows)
+
+
+def _column_names(header):
+    '''
+    Makes the header valid and unique as datastore column names
+    '''
+    columns = []
+    for i, name in enumerate(header):
+        name = str(name or '').strip().replace('"', '').lstrip('_')[:60] or f'column_{i + 1}'
+        unique, n = name, 1
+        while unique in columns:
+            n += 1
+            unique = f'{name[:56]}_{n}'
+        columns.append(unique)
+    return columns
+
+
+def _fit(rows, size):
+    for row in rows:
+        row = list(row)
+        if len(row) != size:
+            row = row[:size] + [None] * (size - len(row))
+        yield row
+
+
+def _as_int(value):
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return str(value)
+    value = str(value).strip()
+    return value if _INT_RE.match(value) else None
+
+
+def _as_numeric(value):
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return repr(value)
+    value = str(value).strip()
+    return value.replace(',', '.') if _NUMERIC_RE.match(value) else None
+
+
+def _as_text(value):
+    return None if value is None else str(value)
+
+
+_COERCERS = {
+    'int8': _as_int,
+    'numeric': _as_numeric,
+    'text': _as_text,
+}
+
+
+def _infer_type(values):
+    values = [v for v in values if v not in (None, '')]
+    if not values:
+        return 'text'
+    if all(_as_int(v) is not None for v in values):
+        return 'int8'
+    if all(_as_numeric(v) is not None for v in values):
+        return 'numeric'
+    return 'text'
+
+
+def _wider(type_a, type_b):
+    return max(type_a, type_b, key=WIDENING.index)
+
+
+def _fitting_type(value, current):
+    '''
+    :return: the narrowest type, not narrower than `current`, the value can be stored as
+    '''
+    for datastore_type in WIDENING[WIDENING.index(current):]:
+        if _COERCERS[datastore_type](value) is not None:
+            return datastore_type
+    return 'text'
+
+
+def _chunks(rows, size):
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+_loader = None
+_loader_lock = threading.Lock()
+
+
+def get_datastore_loader():
+    global _loader
+    if _loader is None:
+        with _loader_lock:
+            if _loader is None:
+                _loader = DatastoreLoader(
+                    chunk_rows=int(config.get(CONFIG_DATASTORE_CHUNK_ROWS, DEFAULT_DATASTORE_CHUNK_ROWS)),
+                    timeout=float(config.get(CONFIG_FETCH_TIMEOUT, DEFAULT_FETCH_TIMEOUT)))
+    return _loader
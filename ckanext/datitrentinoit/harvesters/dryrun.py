@@ -0,0 +1,196 @@
+import copy
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from ckan import model
+from ckan import plugins as p
+
+from ckanext.harvest.model import HarvestObject
+
+from ckanext.datitrentinoit.harvesters.statwebbase import _digest
+
+log = logging.getLogger(__name__)
+
+# package fields set by the mapping and stored as they are
+DIFF_FIELDS = ('title', 'notes', 'url', 'author', 'author_email', 'maintainer', 'maintainer_email', 'license_id')
+
+
+class DryRunReport(object):
+
+    def __init__(self):
+        self.new = []  # guids
+        self.changed = {}  # guid: {field: (stored value, harvested value)}
+        self.deleted = []  # guids
+        self.unchanged = []  # guids
+        self.errors = {}  # guid: error message
+        self.package_ids = {}  # guid: package id
+
+    def summary(self):
+        return (f'new {len(self.new)}, changed {len(self.changed)}, deleted {len(self.deleted)}, '
+                f'unchanged {len(self.unchanged)}, errors {len(self.errors)}')
+
+    def as_dict(self):
+        return {
+            'new': self.new,
+            'changed': {guid: {field: {'stored': old, 'harvested': new} for field, (old, new) in diffs.items()}
+                        for guid, diffs in self.changed.items()},
+            'deleted': self.deleted,
+            'unchanged': self.unchanged,
+            'errors': self.errors,
+            'package_ids': self.package_ids,
+        }
+
+
+def dry_run(harvester, source, resources=False, workers=4, progress=None):
+    '''
+    Compares the content of a StatWeb service with the datasets harvested
+    from it, without writing anything in the DB: the index and the metadata
+    are downloaded (through the shared fetch cache), mapped into package dicts
+    as the import stage would do, and compared with the stored packages.
+    The failed downloads are not added to the negative fetch cache, and no
+    snapshot or job error is stored.
+
+    :param resources: also download the indicator tables and compare the resources
+    :param workers: number of parallel downloads
+    :param progress: optional callable receiving the number of processed entries
+
+    :return: a DryRunReport
+    '''
+    # the harvester plugin instance is shared, work on a copy
+    harvester = copy.copy(harvester)
+    harvester.dry_run = True
+    harvester._set_source_config(source.config)
+
+    current = {guid: (object_id, package_id) for guid, object_id, package_id in
+               model.Session.query(HarvestObject.guid, HarvestObject.id, HarvestObject.package_id)
+                            .filter(HarvestObject.current == True)
+                            .filter(HarvestObject.harvest_source_id == source.id)}
+
+    report = DryRunReport()
+    context = {'model': model, 'session': model.Session, 'ignore_auth': True}
+
+    with harvester.create_index(source.url) as index:
+        guids_in_harvest = index.keys()
+        report.new = sorted(guids_in_harvest - set(current))
+        report.deleted = sorted(set(current) - guids_in_harvest)
+        for guid in report.deleted:
+            report.package_ids[guid] = current[guid][1]
+
+        guids = report.new + sorted(guids_in_harvest & set(current))
+        docs = ((guid, index.get_as_string(guid)) for guid in guids)
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='dry-run') as executor:
+            previews = executor.map(lambda item: _preview(harvester, *item), docs)
+            for guid, (content, error) in zip(guids, previews):
+                if progress:
+                    progress(1)
+                if error is not None:
+                    report.errors[guid] = error
+                    continue
+                if guid not in current:
+                    _check_mapping(harvester, guid, content, report)
+                    continue
+
+                object_id, package_id = current[guid]
+                report.package_ids[guid] = package_id
+                stored_content = model.Session.query(HarvestObject.content) \
+                                              .filter(HarvestObject.id == object_id).scalar()
+                if stored_content and _digest(stored_content) == _digest(content):
+                    # the import stage would skip it
+                    report.unchanged.append(guid)
+                    continue
+
+                try:
+                    package_dict, metadata = harvester.create_package_dict(guid, content)
+                    if resources:
+                        harvester.attach_resources(metadata, package_dict, None)
+                    stored = p.toolkit.get_action('package_show')(context.copy(), {'id': package_id})
+                except p.toolkit.ObjectNotFound:
+                    report.errors[guid] = f'Package {package_id} not found'
+                    continue
+                except Exception as e:
+                    report.errors[guid] = f'Error mapping the entry: {e}'
+                    continue
+
+                diffs = diff_package(package_dict, stored, volatile_extras=harvester.volatile_extras,
+                                     resources=resources)
+                if diffs:
+                    report.changed[guid] = diffs
+                else:
+                    report.unchanged.append(guid)
+
+    # nothing has been written, release the read transaction
+    model.Session.rollback()
+    return report
+
+
+def _preview(harvester, guid, doc):
+    try:
+        return harvester.preview_content(guid, doc), None
+    except Exception as e:
+        return None, f'Error retrieving the entry: {e}'
+
+
+def _check_mapping(harvester, guid, content, report):
+    try:
+        harvester.create_package_dict(guid, content)
+    except Exception as e:
+        report.errors[guid] = f'Error mapping the entry: {e}'
+
+
+def diff_package(package_dict, stored, volatile_extras=(), resources=False):
+    '''
+    :param package_dict: the package dict built by the harvester
+    :param stored: the package dict of the stored dataset, as returned by package_show
+    :param volatile_extras: extras which change at every harvest and are not compared
+
+    :return: {field: (stored value, harvested value)} of the fields which differ
+    '''
+    diffs = {}
+    for field in DIFF_FIELDS:
+        if field in package_dict and _normalize(stored.get(field)) != _normalize(package_dict[field]):
+            diffs[field] = (stored.get(field), package_dict[field])
+
+    stored_groups = sorted(group['name'] for group in stored.get('groups', []))
+    groups = sorted(group['name'] for group in package_dict.get('groups', []))
+    if stored_groups != groups:
+        diffs['groups'] = (stored_groups, groups)
+
+    # the dcatapit schema moves its extras to the top level of the stored package
+    stored_extras = {extra['key']: extra['value'] for extra in stored.get('extras', [])}
+    for extra in package_dict.get('extras', []):
+        key = extra['key']
+        if key in volatile_extras:
+            continue
+        stored_value = stored_extras[key] if key in stored_extras else stored.get(key)
+        if _normalize(stored_value) != _normalize(extra['value']):
+            diffs[f'extras.{key}'] = (stored_value, extra['value'])
+
+    if resources:
+        stored_resources = _resource_keys(stored.get('resources', []))
+        harvested_resources = _resource_keys(package_dict.get('resources', []))
+        if stored_resources != harvested_resources:
+            diffs['resources'] = (stored_resources, harvested_resources)
+
+    return diffs
+
+
+def _resource_keys(resources):
+    return sorted([res.get('url'), res.get('name'), (res.get('format') or '').lower()] for res in resources)
+
+
+def _normalize(value):
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        value = value.strip()
+        if value[:1] in ('[', '{'):
+            try:
+                return json.loads(value)
+            except ValueError:
+                pass
+        return value
+    if isinstance(value, (list, dict)):
+        return value
+    return str(value)
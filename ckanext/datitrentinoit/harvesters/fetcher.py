@@ -0,0 +1,187 @@
+import logging
+import threading
+import time
+import urllib.request as r
+from urllib.error import HTTPError, URLError
+
+from ckan.lib.base import config
+
+from ckanext.datitrentinoit.cache import TTLCache
+from ckanext.datitrentinoit.harvesters.throttle import get_throttle, get_circuit_breaker, parse_retry_after, \
+    CircuitOpenError, HostBlockedError
+
+log = logging.getLogger(__name__)
+
+CONFIG_FETCH_CACHE_TTL = 'ckanext.datitrentinoit.fetch.cache_ttl'
+CONFIG_FETCH_CACHE_SIZE = 'ckanext.datitrentinoit.fetch.cache_size'
+DEFAULT_FETCH_CACHE_TTL = 300
+CONFIG_FETCH_NEGATIVE_TTL = 'ckanext.datitrentinoit.fetch.negative_ttl'
+CONFIG_FETCH_TIMEOUT = 'ckanext.datitrentinoit.fetch.timeout'
+DEFAULT_FETCH_CACHE_SIZE = 500
+DEFAULT_FETCH_NEGATIVE_TTL = 900
+DEFAULT_FETCH_TIMEOUT = 30
+MAX_RETRY_AFTER_ATTEMPTS = 2
+
+
+class FetchSkipped(Exception):
+    '''
+    Raised without contacting the server, when the URL failed recently or
+    its host is failing or asked to wait too long.
+    '''
+    pass
+
+
+class _InFlight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class CoalescingFetcher(object):
+    '''
+    Downloads StatWeb documents, sharing the work among the callers in the
+    same process:
+    - concurrent requests for the same URL wait for a single download;
+    - successful downloads are kept for `ttl` seconds and served to later callers.
+    Downloads are throttled per host (see throttle.HostThrottle).
+
+    Failures are kept in a negative cache for `negative_ttl` seconds, and
+    requests toward hosts which keep failing are refused by a circuit breaker:
+    in both cases FetchSkipped is raised without contacting the server.
+    '''
+
+    def __init__(self, ttl=DEFAULT_FETCH_CACHE_TTL, max_entries=DEFAULT_FETCH_CACHE_SIZE,
+                 negative_ttl=DEFAULT_FETCH_NEGATIVE_TTL, timeout=DEFAULT_FETCH_TIMEOUT):
+        self._cache = TTLCache(ttl, max_entries)
+        self._failures = TTLCache(negative_ttl, max_entries)  # url: error message
+        self.timeout = timeout
+        self._inflight = {}  # url: _InFlight
+        self._lock = threading.Lock()
+
+    def fetch(self, url, remember_failure=True):
+        '''
+        :param remember_failure: add the URL to the negative cache if the download fails
+        :return: the decoded content at the given URL
+        :raise FetchSkipped: if the URL or its host are known to be failing
+        :raise: any error raised while downloading the URL
+        '''
+        content = self._cache.get(url)
+        if content is not None:
+            log.debug('Fetch cache hit for %s', url)
+            return content
+
+        failure = self._failures.get(url)
+        if failure is not None:
+            raise FetchSkipped(f'Skipping {url}, failed recently: {failure}')
+
+        with self._lock:
+            call = self._inflight.get(url)
+            leader = call is None
+            if leader:
+                call = self._inflight[url] = _InFlight()
+
+        if not leader:
+            log.debug('Waiting for in-flight download of %s', url)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._download(url)
+            self._cache.set(url, call.result)
+            return call.result
+        except Exception as e:
+            if remember_failure and not isinstance(e, FetchSkipped):
+                self._failures.set(url, str(e) or e.__class__.__name__)
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[url]
+            call.done.set()
+
+    def _download(self, url):
+        '''
+        Downloads the URL within the limits of the throttle of its host,
+        retrying when the server answers with a Retry-After, unless it is longer
+        than the max_retry_after of the throttle.
+        '''
+        throttle = get_throttle(url)
+        breaker = get_circuit_breaker(url)
+        for attempt in range(MAX_RETRY_AFTER_ATTEMPTS + 1):
+            try:
+                breaker.check()
+            except CircuitOpenError as e:
+                raise FetchSkipped(str(e))
+
+            try:
+                throttle.acquire()
+            except HostBlockedError as e:
+                breaker.cancel()
+                raise FetchSkipped(str(e))
+            start = time.monotonic()
+            try:
+                content = r.urlopen(url, timeout=self.timeout).read().decode()
+            except HTTPError as e:
+                server_error = e.code >= 500 or e.code == 429
+                retry_after = parse_retry_after(e.headers.get('Retry-After')) if e.headers else None
+                throttle.release(time.monotonic() - start, error=server_error, retry_after=retry_after)
+                if server_error:
+                    breaker.failure()
+                else:
+                    breaker.success()
+                if retry_after is None or attempt == MAX_RETRY_AFTER_ATTEMPTS:
+                    raise
+                if retry_after > throttle.max_retry_after:
+                    raise FetchSkipped(f'Skipping {url}, the server asked to retry after {retry_after:.0f}s '
+                                       f'(HTTP {e.code})')
+                log.info('Retrying %s after %ss (HTTP %s)', url, retry_after, e.code)
+            except (URLError, OSError):
+                # connection errors and timeouts
+                throttle.release(time.monotonic() - start, error=True)
+                breaker.failure()
+                raise
+            except Exception:
+                # the host answered, but the content could not be read
+                throttle.release(time.monotonic() - start, error=True)
+                breaker.success()
+                raise
+            else:
+                throttle.release(time.monotonic() - start)
+                breaker.success()
+                return content
+
+    def invalidate(self, url=None):
+        if url is None:
+            self._cache.clear()
+            self._failures.clear()
+        else:
+            self._cache.invalidate(url)
+            self._failures.invalidate(url)
+
+
+_fetcher = None
+_fetcher_lock = threading.Lock()
+
+
+def get_fetcher():
+    '''
+    :return: the CoalescingFetcher shared by all the harvest sources and jobs
+             running in this process
+    '''
+    global _fetcher
+    if _fetcher is None:
+        with _fetcher_lock:
+            if _fetcher is None:
+                _fetcher = CoalescingFetcher(
+                    ttl=int(config.get(CONFIG_FETCH_CACHE_TTL, DEFAULT_FETCH_CACHE_TTL)),
+                    max_entries=int(config.get(CONFIG_FETCH_CACHE_SIZE, DEFAULT_FETCH_CACHE_SIZE)),
+                    negative_ttl=int(config.get(CONFIG_FETCH_NEGATIVE_TTL, DEFAULT_FETCH_NEGATIVE_TTL)),
+                    timeout=float(config.get(CONFIG_FETCH_TIMEOUT, DEFAULT_FETCH_TIMEOUT)))
+    return _fetcher
+
+
+def fetch(url, remember_failure=True):
+    return get_fetcher().fetch(url, remember_failure=remember_failure)
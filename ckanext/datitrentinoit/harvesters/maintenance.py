@@ -0,0 +1,149 @@
+import json
+import logging
+from contextlib import nullcontext
+
+from sqlalchemy import bindparam, text
+
+from ckan import model
+
+from ckanext.harvest.model import HarvestSource
+
+log = logging.getLogger(__name__)
+
+STATWEB_SOURCE_TYPES = ('tn_statweb_pro', 'tn_statweb_subpro')
+
+# Non current objects which are not among the most recent `keep` ones for their
+# guid, older than `cutoff`, and whose processing is over.
+_SUPERSEDED_OBJECTS_SQL = '''
+    FROM (
+        SELECT id, current, state, gathered,
+               row_number() OVER (PARTITION BY guid ORDER BY gathered DESC) AS rn
+        FROM harvest_object
+        WHERE harvest_source_id = :source_id
+    ) o
+    WHERE o.rn > :keep
+      AND o.current IS NOT TRUE
+      AND o.state IN ('COMPLETE', 'ERROR')
+      AND o.gathered < :cutoff
+'''
+
+
+# Indexes backing the current-object lookups of the StatWeb harvesters:
+# - gather_stage and the import prefetch: current objects of a source
+# - import_stage fallback: current object of a guid in a source
+# - compaction: objects of a guid ordered by gather date
+HARVEST_OBJECT_INDEXES = (
+    ('harvest_object_current_source_guid_idx',
+     'harvest_object (harvest_source_id, guid) WHERE current'),
+    ('harvest_object_source_guid_gathered_idx',
+     'harvest_object (harvest_source_id, guid, gathered)'),
+    ('harvest_object_extra_object_key_idx',
+     'harvest_object_extra (harvest_object_id, key)'),
+)
+
+
+def create_harvest_object_indexes(concurrently=False):
+    '''
+    Creates the missing HARVEST_OBJECT_INDEXES.
+
+    :param concurrently: build the indexes without locking the tables against writes
+    :return: a generator yielding the name of each index after it has been processed
+    '''
+    conn = model.meta.engine.connect()
+    try:
+        if concurrently:
+            # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+            conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+        for name, definition in HARVEST_OBJECT_INDEXES:
+            log.info('Creating index %s', name)
+            with nullcontext() if concurrently else conn.begin():
+                conn.execute(text('CREATE INDEX {0}IF NOT EXISTS {1} ON {2}'.format(
+                    'CONCURRENTLY ' if concurrently else '', name, definition)))
+            yield name
+        with nullcontext() if concurrently else conn.begin():
+            conn.execute(text('ANALYZE harvest_object'))
+    finally:
+        conn.close()
+
+
+def get_statweb_sources(source_id_or_name=None):
+    '''
+    :return: the StatWeb harvest sources, or the requested one
+    :raise ValueError: if the requested source is not a StatWeb source
+    '''
+    q = model.Session.query(HarvestSource).filter(HarvestSource.type.in_(STATWEB_SOURCE_TYPES))
+    if not source_id_or_name:
+        return q.all()
+
+    # the source name is the name of the related dataset
+    source_dataset = model.Package.get(source_id_or_name)
+    source_id = source_dataset.id if source_dataset else source_id_or_name
+    source = q.filter(HarvestSource.id == source_id).first()
+    if not source:
+        raise ValueError(f'StatWeb harvest source not found: {source_id_or_name}')
+    return [source]
+
+
+def count_superseded_objects(source_id, keep, cutoff):
+    return model.Session.execute(
+        text('SELECT COUNT(*) ' + _SUPERSEDED_OBJECTS_SQL),
+        {'source_id': source_id, 'keep': keep, 'cutoff': cutoff}).scalar()
+
+
+def compact_harvest_objects(source_id, keep, cutoff, batch_size=1000, archive=None):
+    '''
+    Deletes the superseded harvest objects of a source, along with their
+    extras and errors, committing after each batch; an interrupted run can
+    simply be started again.
+
+    :param keep: number of most recent objects to keep for each guid
+    :param cutoff: only objects gathered before this datetime are deleted
+    :param archive: optional text file where the deleted rows are appended
+                    as JSON lines before being deleted
+    :return: a generator yielding the number of objects deleted by each batch
+    '''
+    select_ids = text('SELECT o.id ' + _SUPERSEDED_OBJECTS_SQL + ' LIMIT :limit')
+    params = {'source_id': source_id, 'keep': keep, 'cutoff': cutoff, 'limit': batch_size}
+
+    while True:
+        ids = [row[0] for row in model.Session.execute(select_ids, params)]
+        if not ids:
+            return
+
+        try:
+            if archive is not None:
+                _archive_objects(ids, archive)
+
+            for table in ('harvest_object_extra', 'harvest_object_error'):
+                model.Session.execute(
+                    text(f'DELETE FROM {table} WHERE harvest_object_id IN :ids')
+                    .bindparams(bindparam('ids', expanding=True)),
+                    {'ids': ids})
+            model.Session.execute(
+                text('DELETE FROM harvest_object WHERE id IN :ids')
+                .bindparams(bindparam('ids', expanding=True)),
+                {'ids': ids})
+            model.Session.commit()
+        except Exception:
+            model.Session.rollback()
+            raise
+
+        yield len(ids)
+
+
+def _archive_objects(ids, archive):
+    def fetch_rows(sql):
+        result = model.Session.execute(text(sql).bindparams(bindparam('ids', expanding=True)), {'ids': ids})
+        keys = list(result.keys())
+        return [dict(zip(keys, row)) for row in result]
+
+    extras = {}
+    for extra in fetch_rows('SELECT harvest_object_id, key, value FROM harvest_object_extra '
+                            'WHERE harvest_object_id IN :ids'):
+        extras.setdefault(extra['harvest_object_id'], {})[extra['key']] = extra['value']
+
+    for row in fetch_rows('SELECT * FROM harvest_object WHERE id IN :ids'):
+        row['extras'] = extras.get(row['id'], {})
+        archive.write(json.dumps(row, default=str))
+        archive.write('\n')
+    archive.flush()
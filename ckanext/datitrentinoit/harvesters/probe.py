@@ -0,0 +1,185 @@
+import email.utils
+import logging
+import threading
+import time
+import urllib.request as r
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+
+from ckan.lib.base import config
+
+from ckanext.datitrentinoit.cache import TTLCache
+from ckanext.datitrentinoit.harvesters.throttle import get_throttle, get_circuit_breaker, CircuitOpenError, \
+    HostBlockedError
+
+log = logging.getLogger(__name__)
+
+CONFIG_PROBE_CONCURRENCY = 'ckanext.datitrentinoit.probe.concurrency'
+CONFIG_PROBE_CACHE_TTL = 'ckanext.datitrentinoit.probe.cache_ttl'
+DEFAULT_PROBE_CONCURRENCY = 4
+DEFAULT_PROBE_CACHE_TTL = 86400
+PROBE_TIMEOUT = 15
+# seconds a client error (e.g. 404) is reused, the URL may be published soon
+PROBE_ERROR_TTL = 900
+
+# resources whose URL answers with one of these codes are reported as missing
+GONE_STATUSES = (404, 410)
+
+
+class ProbeResult(object):
+
+    def __init__(self, status, size=None, last_modified=None, mimetype=None, etag=None):
+        self.status = status
+        self.size = size
+        self.last_modified = last_modified
+        self.mimetype = mimetype
+        self.etag = etag
+
+    def is_gone(self):
+        return self.status in GONE_STATUSES
+
+
+class ResourceProber(object):
+    '''
+    Reads size, modification date and content type of the resource URLs
+    with HEAD requests (falling back to a single byte GET when HEAD is not
+    allowed), without downloading the payloads.
+
+    Results are cached per URL; expired entries with an ETag are revalidated
+    with a conditional request.
+    '''
+
+    def __init__(self, concurrency=DEFAULT_PROBE_CONCURRENCY, ttl=DEFAULT_PROBE_CACHE_TTL):
+        self.concurrency = concurrency
+        self._cache = TTLCache(ttl, max_entries=10000)  # url: ProbeResult
+        self._etags = TTLCache(ttl * 7, max_entries=10000)  # url: ProbeResult with etag, for revalidation
+
+    def enrich(self, resources):
+        '''
+        Probes the URLs of the given resource dicts in parallel and updates them
+        in place. The mimetype set by the harvester is kept.
+
+        :return: the resources whose URL is gone
+        '''
+        urls = list({res['url'] for res in resources if res.get('url')})
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='probe') as executor:
+            results = dict(zip(urls, executor.map(self.probe, urls)))
+
+        gone = []
+        for res in resources:
+            result = results.get(res.get('url'))
+            if result is None:
+                continue
+            if result.is_gone():
+                gone.append(res)
+                continue
+            if result.size is not None:
+                res['size'] = result.size
+            if result.mimetype and not res.get('mimetype'):
+                res['mimetype'] = result.mimetype
+            if result.last_modified and not res.get('last_modified'):
+                res['last_modified'] = result.last_modified
+        return gone
+
+    def probe(self, url):
+        '''
+        :return: a ProbeResult, or None if the URL could not be probed
+        '''
+        result = self._cache.get(url)
+        if result is not None:
+            return result
+
+        previous = self._etags.get(url)
+        try:
+            result = self._request(url, 'HEAD', previous)
+            if result.status == 405:
+                result = self._request(url, 'GET', previous, headers={'Range': 'bytes=0-0'})
+        except (CircuitOpenError, HostBlockedError) as e:
+            log.debug('Not probing %s: %s', url, e)
+            return None
+        except Exception as e:
+            log.debug('Error probing %s: %s', url, e)
+            return None
+
+        if result.status == 304 and previous is not None:
+            result = previous
+        if result.status >= 400:
+            self._cache.set(url, result, ttl=PROBE_ERROR_TTL)
+            return result
+        self._cache.set(url, result)
+        if result.etag:
+            self._etags.set(url, result)
+        return result
+
+    def _request(self, url, method, previous=None, headers=None):
+        headers = dict(headers or {})
+        if previous is not None and previous.etag:
+            headers['If-None-Match'] = previous.etag
+
+        throttle = get_throttle(url)
+        breaker = get_circuit_breaker(url)
+        breaker.check()
+        try:
+            throttle.acquire()
+        except HostBlockedError:
+            breaker.cancel()
+            raise
+        start = time.monotonic()
+        try:
+            response = r.urlopen(r.Request(url, method=method, headers=headers), timeout=PROBE_TIMEOUT)
+            status = response.status
+            response_headers = response.headers
+            response.close()
+        except HTTPError as e:
+            throttle.release(time.monotonic() - start, error=e.code >= 500)
+            if e.code >= 500:
+                breaker.failure()
+                raise
+            breaker.success()
+            return ProbeResult(e.code)
+        except Exception:
+            throttle.release(time.monotonic() - start, error=True)
+            breaker.failure()
+            raise
+        throttle.release(time.monotonic() - start)
+        breaker.success()
+
+        return ProbeResult(status,
+                           size=_parse_size(response_headers),
+                           last_modified=_parse_http_date(response_headers.get('Last-Modified')),
+                           mimetype=(response_headers.get('Content-Type') or '').split(';')[0].strip() or None,
+                           etag=response_headers.get('ETag'))
+
+
+def _parse_size(headers):
+    # partial responses report the full size in Content-Range: bytes 0-0/1234
+    content_range = headers.get('Content-Range')
+    if content_range and '/' in content_range:
+        total = content_range.rsplit('/', 1)[1]
+        return int(total) if total.isdigit() else None
+    length = headers.get('Content-Length')
+    return int(length) if length and length.isdigit() else None
+
+
+def _parse_http_date(value):
+    if not value:
+        return None
+    try:
+        return email.utils.parsedate_to_datetime(value).replace(tzinfo=None).isoformat()
+    except (TypeError, ValueError):
+        return None
+
+
+_prober = None
+_prober_lock = threading.Lock()
+
+
+def get_prober():
+    global _prober
+    if _prober is None:
+        with _prober_lock:
+            if _prober is None:
+                _prober = ResourceProber(
+                    concurrency=int(config.get(CONFIG_PROBE_CONCURRENCY, DEFAULT_PROBE_CONCURRENCY)),
+                    ttl=int(config.get(CONFIG_PROBE_CACHE_TTL, DEFAULT_PROBE_CACHE_TTL)))
+    return _prober
@@ -0,0 +1,234 @@
+import datetime
+import logging
+import queue
+import threading
+import time
+
+from ckan import model
+
+from ckanext.harvest.model import HarvestGatherError, HarvestObject
+import ckanext.harvest.queue as harvest_queue
+
+from ckanext.datitrentinoit.harvesters.throttle import get_throttle_stats
+
+log = logging.getLogger(__name__)
+
+_STOP = object()
+
+# states of the objects whose processing is not over
+PENDING_STATES = ('WAITING', 'FETCH', 'IMPORT')
+
+
+class RunnerStats(object):
+
+    COUNTERS = ('gathered', 'fetched', 'imported', 'unchanged', 'errored')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.monotonic()
+        for counter in self.COUNTERS:
+            setattr(self, counter, 0)
+
+    def incr(self, counter, value=1):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + value)
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def summary(self):
+        elapsed = self.elapsed()
+        done = self.imported + self.unchanged + self.errored
+        rate = done / elapsed if elapsed else 0
+        limits = ' '.join(f'{t["host"]}={t["rate"]}/s,{t["concurrency"]}x' for t in get_throttle_stats())
+        return (f'gathered {self.gathered}, fetched {self.fetched}, imported {self.imported}, '
+                f'unchanged {self.unchanged}, errors {self.errored} '
+                f'[{rate:.1f} obj/s, {elapsed:.0f}s] {limits}')
+
+
+class InProcessRunner(object):
+    '''
+    Runs the gather, fetch and import stages of a harvest job in the current
+    process, without going through the harvest queues.
+
+    The gathered object ids flow through bounded queues to a pool of fetch
+    threads and then to a pool of import threads.
+    Each thread uses its own DB session; `context_factory`, if given, must
+    return a context manager (e.g. a Flask request context) that is kept
+    active for the whole life of each thread.
+    '''
+
+    def __init__(self, harvester, job, fetch_workers=4, import_workers=1, queue_size=100,
+                 context_factory=None, report=None, report_interval=5):
+        self.harvester = harvester
+        self.job = job
+        self.fetch_workers = fetch_workers
+        self.import_workers = import_workers
+        self.context_factory = context_factory
+        self.report = report
+        self.report_interval = report_interval
+        self.stats = RunnerStats()
+        self._fetch_queue = queue.Queue(maxsize=queue_size)
+        self._import_queue = queue.Queue(maxsize=queue_size)
+        self._done = threading.Event()
+
+    def run(self):
+        fetchers = [self._start(self._fetch_worker, f'fetch-{i}') for i in range(self.fetch_workers)]
+        importers = [self._start(self._import_worker, f'import-{i}') for i in range(self.import_workers)]
+        reporter = self._start(self._report_worker, 'report') if self.report else None
+
+        try:
+            object_ids = harvest_queue.gather_stage(self.harvester, self.job) or []
+            self.stats.incr('gathered', len(object_ids))
+            for object_id in object_ids:
+                self._fetch_queue.put(object_id)
+        finally:
+            for _ in fetchers:
+                self._fetch_queue.put(_STOP)
+            for thread in fetchers:
+                thread.join()
+            for _ in importers:
+                self._import_queue.put(_STOP)
+            for thread in importers:
+                thread.join()
+            self._done.set()
+            if reporter:
+                reporter.join()
+
+        return self.stats
+
+    def finalize(self, interrupted=False):
+        '''
+        Marks as errored the objects of the job left pending by an interrupted
+        run, so that the job can be finished and does not block the next
+        jobs of the source.
+
+        :return: the number of objects marked as errored
+        '''
+        model.Session.rollback()
+        now = datetime.datetime.utcnow()
+        pending = model.Session.query(HarvestObject) \
+                               .filter(HarvestObject.harvest_job_id == self.job.id) \
+                               .filter(HarvestObject.state.in_(PENDING_STATES)) \
+                               .update({'state': 'ERROR', 'report_status': 'errored'}, False)
+        if interrupted:
+            job = model.Session.merge(self.job)
+            if job.gather_finished is None:
+                job.gather_finished = now
+            HarvestGatherError(message=f'Run interrupted, {pending} objects not processed', job=job).add()
+        model.Session.commit()
+        if pending:
+            log.warning('Job %s: marked %d pending objects as errored', self.job.id, pending)
+        return pending
+
+    def _start(self, target, name):
+        thread = threading.Thread(target=self._run_in_context, args=(target,), name=f'harvest-{name}', daemon=True)
+        thread.start()
+        return thread
+
+    def _run_in_context(self, target):
+        try:
+            if self.context_factory:
+                with self.context_factory():
+                    target()
+            else:
+                target()
+        finally:
+            model.Session.remove()
+
+    def _fetch_worker(self):
+        while True:
+            object_id = self._fetch_queue.get()
+            if object_id is _STOP:
+                return
+            try:
+                if self._fetch(object_id):
+                    self._import_queue.put(object_id)
+            except Exception as e:
+                log.exception('Error fetching harvest object %s', object_id)
+                self._set_error(object_id, 'Fetch', e)
+
+    def _import_worker(self):
+        while True:
+            object_id = self._import_queue.get()
+            if object_id is _STOP:
+                return
+            try:
+                self._import(object_id)
+            except Exception as e:
+                log.exception('Error importing harvest object %s', object_id)
+                self._set_error(object_id, 'Import', e)
+
+    def _report_worker(self):
+        while not self._done.wait(self.report_interval):
+            self.report(self.stats)
+        self.report(self.stats)
+
+    def _fetch(self, object_id):
+        '''
+        Same bookkeeping as ckanext.harvest.queue.fetch_and_import_stages
+
+        :return: True if the object has to be imported
+        '''
+        obj = HarvestObject.get(object_id)
+        obj.fetch_started = datetime.datetime.utcnow()
+        obj.state = 'FETCH'
+        obj.save()
+
+        success_fetch = self.harvester.fetch_stage(obj)
+        obj.fetch_finished = datetime.datetime.utcnow()
+
+        if success_fetch is True:
+            obj.save()
+            self.stats.incr('fetched')
+            return True
+
+        if success_fetch == 'unchanged':
+            obj.state = 'COMPLETE'
+            obj.report_status = 'not modified'
+            self.stats.incr('unchanged')
+        else:
+            obj.state = 'ERROR'
+            obj.report_status = 'errored'
+            self.stats.incr('errored')
+        obj.save()
+        return False
+
+    def _import(self, object_id):
+        obj = HarvestObject.get(object_id)
+        obj.import_started = datetime.datetime.utcnow()
+        obj.state = 'IMPORT'
+        obj.save()
+
+        success_import = self.harvester.import_stage(obj)
+        obj.import_finished = datetime.datetime.utcnow()
+
+        if not success_import:
+            obj.state = 'ERROR'
+            obj.report_status = 'errored'
+            self.stats.incr('errored')
+        elif success_import == 'unchanged':
+            obj.state = 'COMPLETE'
+            obj.report_status = 'not modified'
+            self.stats.incr('unchanged')
+        else:
+            obj.state = 'COMPLETE'
+            if obj.current is False:
+                obj.report_status = 'deleted'
+            elif model.Session.query(HarvestObject).filter_by(package_id=obj.package_id).limit(2).count() == 2:
+                obj.report_status = 'updated'
+            else:
+                obj.report_status = 'added'
+            self.stats.incr('imported')
+        obj.save()
+
+    def _set_error(self, object_id, stage, error):
+        model.Session.rollback()
+        self.stats.incr('errored')
+        obj = HarvestObject.get(object_id)
+        if obj is None:
+            return
+        obj.state = 'ERROR'
+        obj.report_status = 'errored'
+        obj.save()
+        self.harvester._save_object_error(f'{stage} error: {error}', obj, stage)
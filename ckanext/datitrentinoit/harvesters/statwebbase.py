@@ -1,7 +1,11 @@
 
+import collections
+import datetime
 import hashlib
 import logging
+import threading
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 from ckan.lib.base import config
 
@@ -14,15 +18,40 @@ from ckan.plugins.core import SingletonPlugin, implements
 
 from ckanext.harvest.interfaces import IHarvester
 from ckanext.harvest.harvesters.base import HarvesterBase
-from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.model import HarvestObject, HarvestGatherError, HarvestJob
 from ckanext.harvest.model import HarvestObjectExtra as HOExtra
 
+from ckan.lib.search.common import make_connection
 from ckan.lib.search.index import PackageSearchIndex
+from ckan.common import asbool
+from sqlalchemy import func, inspect as sa_inspect, select, text
 import json
 from ckan.lib.navl.validators import not_empty
 
+import ckanext.datitrentinoit.snapshots as snapshots
+from ckanext.datitrentinoit.harvesters.datastore_loader import get_datastore_loader
+from ckanext.datitrentinoit.harvesters.fetcher import fetch, FetchSkipped
+from ckanext.datitrentinoit.harvesters.probe import get_prober
+from ckanext.datitrentinoit.model.index_store import SpillingIndexStore
+
 log = logging.getLogger(__name__)
 
+CONFIG_INDEX_SPILL_THRESHOLD = 'ckanext.datitrentinoit.index.spill_threshold'
+CONFIG_INDEX_SPILL_DIR = 'ckanext.datitrentinoit.index.spill_dir'
+DEFAULT_INDEX_SPILL_THRESHOLD = 5000
+CONFIG_BULK_DELETE = 'ckanext.datitrentinoit.harvest.bulk_delete'
+BULK_CHUNK_SIZE = 500
+CONFIG_CHECKPOINT_TTL = 'ckanext.datitrentinoit.harvest.checkpoint_ttl'
+DEFAULT_CHECKPOINT_TTL = 86400
+CONFIG_PROBE_RESOURCES = 'ckanext.datitrentinoit.harvest.probe_resources'
+URL_FAILURE_PREFIX = 'Resource could not be loaded'
+# max number of URL failures listed in the report of a job
+URL_FAILURES_MAX = 200
+URL_FAILURES_JOBS = 10
+PREVIOUS_OBJECTS_JOBS = 4
+CONFIG_GATHER_SHARDS = 'ckanext.datitrentinoit.harvest.gather_shards'
+CONFIG_DATASTORE_LOAD = 'ckanext.datitrentinoit.harvest.datastore_load'
+
 
 class StatWebBaseHarvester(HarvesterBase, SingletonPlugin):
     '''
@@ -40,6 +69,24 @@ class StatWebBaseHarvester(HarvesterBase, SingletonPlugin):
 
     source_config = {}
 
+    # job id -> {guid: id} of the current objects, prefetched once per import job
+    _previous_objects = collections.OrderedDict()
+    _previous_objects_lock = threading.Lock()
+
+    # url -> digest of the indicator tables of the object being imported
+    _datastore_digests = None
+
+    # job id -> {url: error} of the resources that could not be loaded
+    _url_failures = {}
+    _url_failures_lock = threading.Lock()
+
+    # set on the copy of the harvester used by the dry run, which must not
+    # store snapshots, record failures or add them to the negative fetch cache
+    dry_run = False
+
+    # extras which change at every import, ignored by the dry run diff
+    volatile_extras = ('issued',)
+
     def harvester_name(self):
         raise NotImplementedError
 
@@ -48,12 +95,32 @@ class StatWebBaseHarvester(HarvesterBase, SingletonPlugin):
         return an object exposing the methods:
         - keys(): return all the keys of the harvested documents
         - index.get_as_string(key): return the document entry related to a key
+        - close(): release the resources held by the index
         """
         raise NotImplementedError
 
+    def _create_index_store(self):
+        '''
+        Returns the store holding the index entries for a single harvest run.
+        Entries are kept in memory, and moved to a temporary SQLite db when
+        their number exceeds `ckanext.datitrentinoit.index.spill_threshold`
+        (overridable in the source config as "index_spill_threshold").
+        '''
+        threshold = self.source_config.get('index_spill_threshold',
+                                           config.get(CONFIG_INDEX_SPILL_THRESHOLD, DEFAULT_INDEX_SPILL_THRESHOLD))
+        return SpillingIndexStore(threshold=int(threshold or 0),
+                                  basedir=config.get(CONFIG_INDEX_SPILL_DIR) or None)
+
     def create_package_dict(self, guid, content):
         raise NotImplementedError
 
+    def preview_content(self, guid, doc):
+        '''
+        Returns the content that the harvest object of an index entry would
+        hold at the import stage, without storing anything (used by the dry run).
+        '''
+        return doc
+
     def attach_resources(self, metadata, package_dict):
         raise NotImplementedError
 
@@ -94,7 +161,13 @@ class StatWebBaseHarvester(HarvesterBase, SingletonPlugin):
             log.warning(f"Error while creating index: {e}")
             return None
 
+        try:
+            return self._gather_objects(harvest_job, index)
+        finally:
+            # release the index entries (and any disk spill) at the end of the run
+            index.close()
 
+    def _gather_objects(self, harvest_job, index):
         query = model.Session.query(HarvestObject.guid, HarvestObject.package_id).\
                                     filter(HarvestObject.current == True).\
                                     filter(HarvestObject.harvest_source_id == harvest_job.source.id)
@@ -112,39 +185,181 @@ class StatWebBaseHarvester(HarvesterBase, SingletonPlugin):
         delete = guids_in_db - guids_in_harvest
         change = guids_in_db & guids_in_harvest
 
-        ids = []
-        for guid in new:
-            doc = index.get_as_string(guid)
-            obj = HarvestObject(guid=guid, job=harvest_job, content=doc,
-                                extras=[HOExtra(key='status', value='new')])
-            obj.save()
-            ids.append(obj.id)
-
-        for guid in change:
-            doc = index.get_as_string(guid)
-            obj = HarvestObject(guid=guid, job=harvest_job, content=doc,
-                                package_id=guid_to_package_id[guid],
-                                extras=[HOExtra(key='status', value='change')])
-            obj.save()
-            ids.append(obj.id)
-
-        for guid in delete:
-            obj = HarvestObject(guid=guid, job=harvest_job,
-                                package_id=guid_to_package_id[guid],
-                                extras=[HOExtra(key='status', value='delete')])
-            ids.append(obj.id)
-            model.Session.query(HarvestObject).\
-                  filter_by(guid=guid).\
-                  update({'current': False}, False)
-            obj.save()
-
-        if len(ids) == 0:
+        shards = int(self.source_config.get('gather_shards', config.get(CONFIG_GATHER_SHARDS, 1)) or 1)
+        if shards > 1:
+            ids = self._gather_sharded(harvest_job, index, new | change, change, guid_to_package_id, shards)
+        else:
+            ids = []
+            for guid in new:
+                doc = index.get_as_string(guid)
+                obj = HarvestObject(guid=guid, job=harvest_job, content=doc,
+                                    extras=[HOExtra(key='status', value='new'),
+                                            HOExtra(key='index_digest', value=_digest(doc))])
+                obj.save()
+                ids.append(obj.id)
+
+            for guid in change:
+                doc = index.get_as_string(guid)
+                obj = HarvestObject(guid=guid, job=harvest_job, content=doc,
+                                    package_id=guid_to_package_id[guid],
+                                    extras=[HOExtra(key='status', value='change'),
+                                            HOExtra(key='index_digest', value=_digest(doc))])
+                obj.save()
+                ids.append(obj.id)
+
+        bulk_deleted = False
+        if delete and self._use_bulk_delete():
+            bulk_deleted = self._bulk_delete(harvest_job, {guid: guid_to_package_id[guid] for guid in delete})
+
+        if not bulk_deleted:
+            for guid in delete:
+                obj = HarvestObject(guid=guid, job=harvest_job,
+                                    package_id=guid_to_package_id[guid],
+                                    extras=[HOExtra(key='status', value='delete')])
+                model.Session.query(HarvestObject).\
+                      filter_by(guid=guid).\
+                      update({'current': False}, False)
+                obj.save()
+                ids.append(obj.id)
+
+        if len(ids) == 0 and not bulk_deleted:
             self._save_gather_error('No records received from the %s service' % self.harvester_name(), harvest_job)
             return None
 
         return ids
 
 
+    def _gather_sharded(self, harvest_job, index, guids, change, guid_to_package_id, shards):
+        '''
+        Splits the guids into `shards` partitions, using a stable hash of the guid,
+        and creates the new/change objects of each partition in its own worker
+        thread, DB session and transaction.
+        The caller acts as coordinator: it merges the returned ids, and handles
+        the deleted guids. If a shard fails, the objects committed by the other
+        shards are deleted before the error is raised, so that no partial job
+        is left behind.
+
+        :param change: the guids already harvested, the others are new
+        :return: the ids of the created objects
+        '''
+        log = logging.getLogger(__name__ + '.gather')
+
+        partitions = [[] for _ in range(shards)]
+        for guid in guids:
+            partitions[shard_for_guid(guid, shards)].append(guid)
+
+        log.info('%s: gathering %d objects in %d shards (%s)', self.harvester_name(), len(guids), shards,
+                 ', '.join(str(len(partition)) for partition in partitions))
+
+        ids = []
+        error = None
+        with ThreadPoolExecutor(max_workers=shards, thread_name_prefix='gather-shard') as executor:
+            futures = [executor.submit(self._gather_shard, harvest_job.id, harvest_job.source.id,
+                                       index, partition, change, guid_to_package_id)
+                       for partition in partitions if partition]
+            for future in futures:
+                try:
+                    ids.extend(future.result())
+                except Exception as e:
+                    error = error or e
+
+        if error is not None:
+            log.error('%s: a gather shard failed, deleting the %d objects of the other shards',
+                      self.harvester_name(), len(ids))
+            try:
+                _delete_objects(ids)
+            except Exception as e:
+                log.error('%s: could not delete the objects of the gather shards: %s', self.harvester_name(), e)
+            raise error
+        return ids
+
+    def _gather_shard(self, harvest_job_id, harvest_source_id, index, guids, change, guid_to_package_id):
+        try:
+            objects = []
+            for guid in guids:
+                doc = index.get_as_string(guid)
+                status = 'change' if guid in change else 'new'
+                obj = HarvestObject(guid=guid, harvest_job_id=harvest_job_id, harvest_source_id=harvest_source_id,
+                                    content=doc, package_id=guid_to_package_id.get(guid),
+                                    extras=[HOExtra(key='status', value=status),
+                                            HOExtra(key='index_digest', value=_digest(doc))])
+                model.Session.add(obj)
+                objects.append(obj)
+            model.Session.commit()
+            return [obj.id for obj in objects]
+        except Exception:
+            model.Session.rollback()
+            raise
+        finally:
+            # each worker thread has its own scoped session
+            model.Session.remove()
+
+    def _use_bulk_delete(self):
+        return asbool(self.source_config.get('bulk_delete', config.get(CONFIG_BULK_DELETE, False)))
+
+    def _bulk_delete(self, harvest_job, guid_to_package_id):
+        '''
+        Deletes the packages related to the given guids in a single transaction,
+        then removes them from the search index in batches.
+
+        The "delete" harvest objects are stored as already completed, so they
+        are not queued for the fetch and import stages.
+        Note that no activity is created and the IPackageController.delete
+        hooks are not called for these packages; their metadata_modified is
+        updated, so that they are not served from the package_show and
+        recent_updates caches of the web processes.
+
+        :return: False if the DB update failed, so that the caller can fall
+                 back to the per-object deletion
+        '''
+        log = logging.getLogger(__name__ + '.gather')
+
+        guids = list(guid_to_package_id.keys())
+        package_ids = [package_id for package_id in guid_to_package_id.values() if package_id]
+        now = datetime.datetime.utcnow()
+
+        log.info('%s: bulk deleting %d packages', self.harvester_name(), len(package_ids))
+        try:
+            for chunk in _chunks(guids, BULK_CHUNK_SIZE):
+                model.Session.query(HarvestObject).\
+                      filter(HarvestObject.guid.in_(chunk)).\
+                      update({'current': False}, False)
+
+            for guid in guids:
+                HarvestObject(guid=guid, job=harvest_job,
+                              package_id=guid_to_package_id[guid],
+                              current=False,
+                              state='COMPLETE',
+                              report_status='deleted',
+                              fetch_started=now, fetch_finished=now,
+                              import_started=now, import_finished=now,
+                              extras=[HOExtra(key='status', value='delete')]).add()
+
+            for chunk in _chunks(package_ids, BULK_CHUNK_SIZE):
+                # metadata_modified is part of the package_show cache key
+                model.Session.query(model.Package).\
+                      filter(model.Package.id.in_(chunk)).\
+                      update({'state': model.State.DELETED, 'metadata_modified': now}, False)
+                model.Session.query(model.Member).\
+                      filter(model.Member.table_id.in_(chunk)).\
+                      filter(model.Member.state == model.State.ACTIVE).\
+                      update({'state': model.State.DELETED}, False)
+
+            model.Session.commit()
+        except Exception as e:
+            model.Session.rollback()
+            log.error('%s: bulk delete failed, falling back to single deletes: %s', self.harvester_name(), e)
+            return False
+
+        try:
+            _delete_from_search_index(package_ids)
+        except Exception as e:
+            self._save_gather_error('Error removing %d deleted packages from the search index, '
+                                    'a search-index rebuild is needed: %s' % (len(package_ids), e), harvest_job)
+
+        log.info('%s: bulk deleted %d packages', self.harvester_name(), len(package_ids))
+        return True
+
     def fetch_stage(self, harvest_object):
         return True
 
@@ -170,12 +385,6 @@ class StatWebBaseHarvester(HarvesterBase, SingletonPlugin):
 
         status = self._get_object_extra(harvest_object, 'status')
 
-        # Get the last harvested object (if any)
-        previous_object = Session.query(HarvestObject) \
-                          .filter(HarvestObject.guid == harvest_object.guid) \
-                          .filter(HarvestObject.current == True) \
-                          .first()
-
         context = {'model': model, 'session': model.Session, 'user': self._get_user_name()}
 
         if status == 'delete':
@@ -185,6 +394,15 @@ class StatWebBaseHarvester(HarvesterBase, SingletonPlugin):
 
             return True
 
+        # Skip the objects already imported by an interrupted attempt (e.g. a re-delivered message)
+        if harvest_object.current and \
+                self._get_object_extra(harvest_object, 'imported_digest') == _digest(harvest_object.content):
+            log.info('%s document with GUID %s already imported, skipping...', self.harvester_name(), harvest_object.guid)
+            return "unchanged"
+
+        # Get the last harvested object (if any)
+        previous_object = self._get_previous_object(harvest_object)
+
         # Flag previous object as not current anymore
         if previous_object:
             previous_object.current = False
@@ -201,16 +419,11 @@ class StatWebBaseHarvester(HarvesterBase, SingletonPlugin):
             return False
 
         # pre-check to skip resource logic in case no changes occurred remotely
-        if status == 'change':
+        if status == 'change' and previous_object:
 
             # Check if the document has changed
-            m = hashlib.md5()
-            m.update(previous_object.content.encode())
-            old_md5 = m.hexdigest()
-
-            m = hashlib.md5()
-            m.update(harvest_object.content.encode())
-            new_md5 = m.hexdigest()
+            old_md5 = _digest(previous_object.content)
+            new_md5 = _digest(harvest_object.content)
 
             if old_md5 == new_md5:
 
@@ -221,6 +434,10 @@ class StatWebBaseHarvester(HarvesterBase, SingletonPlugin):
                 harvest_object.metadata_modified_date = previous_object.metadata_modified_date
                 harvest_object.add()
 
+                datastore_digests = self._get_object_extra(previous_object, 'datastore_digests')
+                if datastore_digests:
+                    self._set_object_extra(harvest_object, 'datastore_digests', datastore_digests)
+
                 # Delete the previous object to avoid cluttering the object table
                 previous_object.delete()
 
@@ -238,8 +455,13 @@ class StatWebBaseHarvester(HarvesterBase, SingletonPlugin):
                     if package_dict:
                         package_index = PackageSearchIndex()
                         package_index.index_package(package_dict)
+                    if self._datastore_load_enabled():
+                        # retry the tables whose load failed in a previous job
+                        self._load_datastore(package_dict['resources'], harvest_object,
+                                             json.loads(datastore_digests or '{}'))
 
                 log.info('%s document with GUID %s unchanged, skipping...', self.harvester_name(),harvest_object.guid)
+                self._set_object_extra(harvest_object, 'imported_digest', new_md5)
                 model.Session.commit()
 
                 return "unchanged"
@@ -259,8 +481,12 @@ class StatWebBaseHarvester(HarvesterBase, SingletonPlugin):
         if source_dataset.owner_org:
             package_dict['owner_org'] = source_dataset.owner_org
 
+        self._datastore_digests = {}
         self.attach_resources(metadata, package_dict, harvest_object)
 
+        if asbool(self.source_config.get('probe_resources', config.get(CONFIG_PROBE_RESOURCES, False))):
+            self._enrich_resources(package_dict, harvest_object)
+
         # Create / update the package
 
         context = {'model': model,
@@ -310,6 +536,8 @@ class StatWebBaseHarvester(HarvesterBase, SingletonPlugin):
             context['schema'] = package_schema
 
             package_dict['id'] = harvest_object.package_id
+            if self._datastore_load_enabled():
+                self._reuse_resource_ids(package_dict)
             try:
                 package_id = p.toolkit.get_action('package_update')(context, package_dict)
                 log.info('%s updated package %s with guid %s', self.harvester_name(), package_id, harvest_object.guid)
@@ -317,11 +545,67 @@ class StatWebBaseHarvester(HarvesterBase, SingletonPlugin):
                 self._save_object_error('Validation Error: %s' % str(e.error_summary), harvest_object, 'Import')
                 return False
 
+        self._set_object_extra(harvest_object, 'imported_digest', _digest(harvest_object.content))
+        if self._datastore_digests:
+            # kept for the jobs finding the object unchanged, to retry the failed loads
+            self._set_object_extra(harvest_object, 'datastore_digests', json.dumps(self._datastore_digests))
         model.Session.commit()
 
+        if self._datastore_load_enabled():
+            show_context = {'model': model, 'session': model.Session, 'user': self._get_user_name(),
+                            'ignore_auth': True}
+            package_dict = p.toolkit.get_action('package_show')(show_context, {'id': package_id})
+            self._load_datastore(package_dict['resources'], harvest_object, self._datastore_digests or {})
+
         return True
             
 
+    def _get_previous_object(self, harvest_object):
+        '''
+        Returns the current harvest object with the same guid in the same source, if any.
+
+        The guid -> object id map of the current objects is loaded with a single
+        query the first time an object of a job is imported, and reused for
+        the following objects of the same job. The maps of the latest
+        PREVIOUS_OBJECTS_JOBS jobs are kept, so that the objects of several
+        sources can be imported by the same worker.
+        '''
+        job_id = harvest_object.harvest_job_id
+        source_id = harvest_object.source.id
+
+        with self._previous_objects_lock:
+            previous_objects = self._previous_objects.get(job_id)
+            if previous_objects is None:
+                query = Session.query(HarvestObject.guid, HarvestObject.id) \
+                               .filter(HarvestObject.current == True) \
+                               .filter(HarvestObject.harvest_source_id == source_id)
+                previous_objects = self._previous_objects[job_id] = dict(query)
+                while len(self._previous_objects) > PREVIOUS_OBJECTS_JOBS:
+                    self._previous_objects.popitem(last=False)
+                log.debug('%s: prefetched %d current objects for job %s',
+                          self.harvester_name(), len(previous_objects), job_id)
+            else:
+                self._previous_objects.move_to_end(job_id)
+            object_id = previous_objects.get(harvest_object.guid)
+
+        if object_id is None:
+            return None
+        if object_id == harvest_object.id:
+            # a re-delivered object which is already the current one
+            object_id = None
+
+        previous_object = Session.query(HarvestObject).get(object_id) if object_id else None
+        if previous_object is not None and previous_object.current:
+            return previous_object
+
+        # the map is stale (e.g. the object has been imported by another worker)
+        return Session.query(HarvestObject) \
+                      .filter(HarvestObject.guid == harvest_object.guid) \
+                      .filter(HarvestObject.harvest_source_id == source_id) \
+                      .filter(HarvestObject.current == True) \
+                      .filter(HarvestObject.id != harvest_object.id) \
+                      .first()
+
     def _set_source_config(self, config_str):
         '''
         Loads the source configuration JSON object into a dict for
@@ -343,6 +627,186 @@ class StatWebBaseHarvester(HarvesterBase, SingletonPlugin):
                 return extra.value
         return None
 
+    def _set_object_extra(self, harvest_object, key, value):
+        '''
+        Helper function for setting the value of a harvest object extra,
+        creating it if needed
+        '''
+        for extra in harvest_object.extras:
+            if extra.key == key:
+                extra.value = value
+                return
+        harvest_object.extras.append(HOExtra(key=key, value=value))
+
+    def _checkpoint_fetch(self, harvest_object):
+        '''
+        Records that the content of the object has been fetched, and from
+        which index entry.
+        Must be called before saving the fetched content.
+        '''
+        self._set_object_extra(harvest_object, 'fetched_digest',
+                               self._get_object_extra(harvest_object, 'index_digest') or '')
+        self._set_object_extra(harvest_object, 'fetched_at', datetime.datetime.utcnow().isoformat())
+
+    def _resume_fetch(self, harvest_object):
+        '''
+        Reuses the content fetched by a previous attempt for the same index entry,
+        either by this same object (re-queued) or by an object of an interrupted
+        (not finished) job gathered within `ckanext.datitrentinoit.harvest.checkpoint_ttl`
+        seconds.
+
+        :return: True if harvest_object holds valid fetched content and can skip the fetch
+        '''
+        index_digest = self._get_object_extra(harvest_object, 'index_digest')
+        if not index_digest:
+            return False
+
+        if self._get_object_extra(harvest_object, 'fetched_digest') == index_digest:
+            log.info('%s: object %s already fetched, resuming', self.harvester_name(), harvest_object.id)
+            return True
+
+        ttl = int(config.get(CONFIG_CHECKPOINT_TTL, DEFAULT_CHECKPOINT_TTL))
+        if ttl <= 0:
+            return False
+
+        # only the jobs which did not finish: the content fetched by a finished
+        # job has been imported, and an unchanged index entry (e.g. the id and
+        # URL of a Pro indicator) does not mean that the metadata is unchanged
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=ttl)
+        fetched = Session.query(HarvestObject) \
+                         .join(HOExtra, HOExtra.harvest_object_id == HarvestObject.id) \
+                         .join(HarvestJob, HarvestJob.id == HarvestObject.harvest_job_id) \
+                         .filter(HarvestObject.guid == harvest_object.guid) \
+                         .filter(HarvestObject.harvest_source_id == harvest_object.source.id) \
+                         .filter(HarvestObject.id != harvest_object.id) \
+                         .filter(HarvestObject.harvest_job_id != harvest_object.harvest_job_id) \
+                         .filter(HarvestJob.status != 'Finished') \
+                         .filter(HarvestObject.gathered >= cutoff) \
+                         .filter(HOExtra.key == 'fetched_digest') \
+                         .filter(HOExtra.value == index_digest) \
+                         .order_by(HarvestObject.gathered.desc()) \
+                         .first()
+        if not fetched or not fetched.content:
+            return False
+
+        log.info('%s: reusing content fetched by object %s for GUID %s',
+                 self.harvester_name(), fetched.id, harvest_object.guid)
+        harvest_object.content = fetched.content
+        self._checkpoint_fetch(harvest_object)
+        harvest_object.save()
+        return True
+
+    def _enrich_resources(self, package_dict, harvest_object):
+        '''
+        Fills size, missing mimetype and last_modified of the resources from the
+        headers of their URLs, and reports the resources whose URL does not exist.
+        '''
+        gone = get_prober().enrich(package_dict['resources'])
+        for res in gone:
+            self._record_url_failure(harvest_object, res['url'], ValueError('resource not found'))
+
+    def _fetch(self, url):
+        return fetch(url, remember_failure=not self.dry_run)
+
+    def _store_snapshot(self, url, content, obj):
+        '''
+        Stores the columnar snapshot of a downloaded indicator table, if snapshots are enabled
+        '''
+        if self.dry_run or not snapshots.snapshots_enabled():
+            return
+        try:
+            snapshots.store_snapshot(url, content, obj)
+        except Exception as e:
+            log.warning('%s: could not store the snapshot of %s: %s', self.harvester_name(), url, e)
+
+    def _datastore_load_enabled(self):
+        return asbool(self.source_config.get('datastore_load', config.get(CONFIG_DATASTORE_LOAD, False)))
+
+    def _set_datastore_digest(self, res_dict, content):
+        '''
+        Marks the resource to be loaded into the datastore, with the digest of
+        the indicator table it holds, if datastore loading is enabled.
+        The digests are kept by URL in self._datastore_digests, not in the
+        resource dict, which is public.
+        '''
+        if self._datastore_load_enabled() and not self.dry_run:
+            if self._datastore_digests is None:
+                self._datastore_digests = {}
+            self._datastore_digests[res_dict['url']] = _digest(content)
+
+    def _reuse_resource_ids(self, package_dict):
+        '''
+        Keeps the ids of the existing resources whose URL did not change, so
+        that their datastore tables are kept and only reloaded if their content changed.
+        '''
+        context = {'model': model, 'session': model.Session, 'user': self._get_user_name(), 'ignore_auth': True}
+        try:
+            existing = p.toolkit.get_action('package_show')(context, {'id': package_dict['id']})
+        except p.toolkit.ObjectNotFound:
+            return
+
+        by_url = {res['url']: res for res in existing.get('resources', [])}
+        for res in package_dict['resources']:
+            old = by_url.pop(res['url'], None)
+            if old is None:
+                continue
+            res['id'] = old['id']
+            if old.get('datastore_active'):
+                res['datastore_active'] = True
+
+    def _load_datastore(self, resources, harvest_object, digests):
+        '''
+        Loads into the datastore the resources marked by _set_datastore_digest,
+        unless the table already holds the same content
+
+        :param digests: {url: digest} of the resources to load
+        '''
+        if not p.plugin_loaded('datastore'):
+            log.warning('%s: %s is set, but the datastore plugin is not enabled',
+                        self.harvester_name(), CONFIG_DATASTORE_LOAD)
+            return
+
+        context = {'model': model, 'session': model.Session, 'user': self._get_user_name(), 'ignore_auth': True}
+        loader = get_datastore_loader()
+        for res in resources:
+            digest = digests.get(res['url'])
+            if not digest:
+                continue
+            try:
+                loader.load(context, res, digest)
+            except Exception as e:
+                self._record_url_failure(harvest_object, res['url'], e)
+
+    def _record_url_failure(self, harvest_object, url, error):
+        '''
+        Adds a resource URL that could not be loaded to the report of the job,
+        as a gather error listed once even if the URL is used by several
+        objects or processes working on the job.
+        '''
+        reason = str(error) or error.__class__.__name__
+        if self.dry_run or harvest_object is None:
+            log.warning('%s: error loading %s: %s', self.harvester_name(), url, reason)
+            return
+
+        job_id = harvest_object.harvest_job_id
+
+        if isinstance(error, FetchSkipped):
+            log.debug('%s: skipped %s for GUID %s: %s', self.harvester_name(), url, harvest_object.guid, reason)
+        else:
+            log.warning('%s: error loading %s for GUID %s: %s', self.harvester_name(), url, harvest_object.guid, reason)
+
+        # the URLs already recorded by this process, to spare the DB updates
+        with self._url_failures_lock:
+            failures = self._url_failures.setdefault(job_id, {})
+            if url in failures:
+                return
+            failures[url] = reason
+            # only keep the URLs of the latest jobs
+            for old_job_id in list(self._url_failures)[:-URL_FAILURES_JOBS]:
+                del self._url_failures[old_job_id]
+
+        _add_url_failure(job_id, url, reason)
+
     def _get_user_name(self):
         '''
         Returns the name of the user that will perform the harvesting actions
@@ -368,3 +832,83 @@ class StatWebBaseHarvester(HarvesterBase, SingletonPlugin):
             self._user_name = self._site_user['name']
 
         return self._user_name
+
+
+def shard_for_guid(guid, shards):
+    '''
+    :return: the shard (0..shards-1) a guid belongs to, stable across processes and runs
+    '''
+    return int(hashlib.md5(guid.encode()).hexdigest()[:8], 16) % shards
+
+
+def _digest(content):
+    return hashlib.md5(content.encode()).hexdigest()
+
+
+def _add_url_failure(job_id, url, reason):
+    '''
+    Adds a gather error for an URL to the job, unless it was already added by
+    this or another process, or the job already lists URL_FAILURES_MAX URLs.
+    Uses its own transaction, so it can be called in the middle of a stage
+    without committing the stage session.
+    '''
+    table = sa_inspect(HarvestGatherError).local_table
+    prefix = URL_FAILURE_PREFIX + ': '
+    key = f'{prefix}{url}: '
+    with model.meta.engine.begin() as conn:
+        # serialize the failures of a job among processes
+        conn.execute(text('SELECT pg_advisory_xact_lock(hashtext(:key))'), key=f'url_failures:{job_id}')
+        failures = conn.execute(select([func.count()])
+                                .where(table.c.harvest_job_id == job_id)
+                                .where(table.c.message.startswith(prefix, autoescape=True))).scalar()
+        if failures > URL_FAILURES_MAX:
+            return
+        if failures == URL_FAILURES_MAX:
+            message = f'{prefix}more than {URL_FAILURES_MAX} resources, the others are only logged'
+        else:
+            if conn.execute(select([table.c.id])
+                            .where(table.c.harvest_job_id == job_id)
+                            .where(table.c.message.startswith(key, autoescape=True))).first():
+                return
+            message = key + ' '.join(reason.splitlines())
+        conn.execute(table.insert().values(harvest_job_id=job_id, message=message))
+
+
+def _delete_objects(object_ids):
+    '''
+    Deletes the given harvest objects and their extras
+    '''
+    try:
+        for chunk in _chunks(object_ids, BULK_CHUNK_SIZE):
+            model.Session.query(HOExtra).\
+                  filter(HOExtra.harvest_object_id.in_(chunk)).\
+                  delete(synchronize_session=False)
+            model.Session.query(HarvestObject).\
+                  filter(HarvestObject.id.in_(chunk)).\
+                  delete(synchronize_session=False)
+        model.Session.commit()
+    except Exception:
+        model.Session.rollback()
+        raise
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _delete_from_search_index(package_ids):
+    '''
+    Removes the given packages from Solr using batched delete-by-id requests
+    and a single final commit.
+    '''
+    if not package_ids:
+        return
+    site_id = config.get('ckan.site_id')
+    # same unique key computed by ckan.lib.search.index.PackageSearchIndex
+    index_ids = [hashlib.md5(f'{package_id}{site_id}'.encode()).hexdigest() for package_id in package_ids]
+    conn = make_connection()
+    for chunk in _chunks(index_ids, BULK_CHUNK_SIZE):
+        conn.delete(id=chunk, commit=False)
+    if asbool(config.get('ckan.search.solr_commit', 'true')):
+        conn.commit()
@@ -2,7 +2,6 @@
 import logging
 import json
 import requests
-import urllib.request as r
 from urllib.parse import urlparse, urlunparse
 
 from ckan.plugins.core import SingletonPlugin
@@ -58,8 +57,8 @@ class StatWebProHarvester(StatWebBaseHarvester, SingletonPlugin):
 
     def create_index(self, url):
         log.info('%s: connecting to %s', self.harvester_name(), url)
-        content = r.urlopen(url).read().decode()
-        return StatWebProIndex(content)
+        content = self._fetch(url)
+        return StatWebProIndex(content, store=self._create_index_store())
 
     def create_package_dict(self, guid, content):
         swpentry = StatWebProEntry(txt=content)
@@ -67,6 +66,12 @@ class StatWebProHarvester(StatWebBaseHarvester, SingletonPlugin):
         package_dict = mapping.create_pro_package_dict(guid, swpentry, metadata, self.source_config)
         return package_dict, metadata
 
+    def preview_content(self, guid, doc):
+        entry = StatWebProEntry(txt=doc)
+        metadata = StatWebMetadataPro(txt=self._fetch(entry.get_url()))
+        entry.set_metadata(metadata.get_obj())
+        return entry.tostring()
+
     def fetch_stage(self, harvest_object):
 
         # Check harvest object status
@@ -86,12 +91,16 @@ class StatWebProHarvester(StatWebBaseHarvester, SingletonPlugin):
 
         identifier = harvest_object.guid
 
+        # Skip the download if this entry has already been fetched by an interrupted attempt
+        if self._resume_fetch(harvest_object):
+            return True
+
         log.info('Retrieving StatWebPro metadata from %s', url)
 
         try:
-            content = r.urlopen(url).read().decode()
+            content = self._fetch(url)
         except Exception as e:
-            self._save_object_error('Error getting the StatWebPro record with GUID %s' % identifier, harvest_object)
+            self._save_object_error(f'Error getting the StatWebPro record with GUID {identifier} [{e}]', harvest_object)
             return False
 
         if content is None:
@@ -111,6 +120,7 @@ class StatWebProHarvester(StatWebBaseHarvester, SingletonPlugin):
         # Update the harvest_object content, adding the metadata
         try:
             harvest_object.content = entry.tostring()
+            self._checkpoint_fetch(harvest_object)
             harvest_object.save()
         except Exception as e:
             self._save_object_error(f'Error saving the harvest object for GUID {identifier} [{e}]',
@@ -134,15 +144,17 @@ class StatWebProHarvester(StatWebBaseHarvester, SingletonPlugin):
             # json_resource_url = reroute_url(json_resource_url, harvest_object.job.source.url)
 
             try:
-                rdata = r.urlopen(json_resource_url).read().decode()
+                rdata = self._fetch(json_resource_url)
                 robj = _safe_decode(rdata)
                 log.debug('StatWebPro: loaded resource %s', resource_key)
             except Exception as e:
-                log.error(f'StatWebPro error in GUID {harvest_object.guid} while loading resource {resource_key} at {json_resource_url}')
+                self._record_url_failure(harvest_object, json_resource_url, e)
                 continue
 
             res_title = list(robj.keys())[0]
 
+            self._store_snapshot(json_resource_url, rdata, robj)
+
             res_dict_json = {
                 'name': res_title,
                 'description': res_title,
@@ -159,6 +171,7 @@ class StatWebProHarvester(StatWebBaseHarvester, SingletonPlugin):
             # Get also the twin CSV resource
             csv_resource_url = metadata.get(resource_key + "CSV")
             if not csv_resource_url:
+                self._set_datastore_digest(res_dict_json, rdata)
                 continue
 
             res_dict_csv = {
@@ -172,6 +185,7 @@ class StatWebProHarvester(StatWebBaseHarvester, SingletonPlugin):
                 'distribution_format': 'CSV',  # dcatapit
                 'license_type': package_dict['license_url'],  # dcatapit
             }
+            self._set_datastore_digest(res_dict_csv, rdata)
             package_dict['resources'].append(res_dict_csv)
 
 
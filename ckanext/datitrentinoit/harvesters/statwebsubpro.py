@@ -1,12 +1,11 @@
 
 import logging
-import requests
-import urllib.request as r
 
 import json
 from ckan.plugins.core import SingletonPlugin
 
-from ckanext.datitrentinoit.model.statweb_metadata import StatWebSubProIndex, StatWebMetadataSubPro, SubProMetadata
+from ckanext.datitrentinoit.model.statweb_metadata import StatWebSubProIndex, StatWebMetadataSubPro, SubProMetadata, \
+    _safe_decode
 import ckanext.datitrentinoit.model.mapping as mapping
 
 from ckanext.datitrentinoit.harvesters.statwebbase import StatWebBaseHarvester
@@ -33,6 +32,9 @@ class StatWebSubProHarvester(StatWebBaseHarvester, SingletonPlugin):
             'form_config_interface': 'Text'
         }
 
+    # the SubPro identifier is a random uuid
+    volatile_extras = ('issued', 'identifier')
+
     def harvester_name(self):
         return 'StatWebSubPro'
 
@@ -56,25 +58,25 @@ class StatWebSubProHarvester(StatWebBaseHarvester, SingletonPlugin):
 
     def create_index(self, url):
         log.info('%s: connecting to %s', self.harvester_name(), url)
-        content = r.urlopen(url).read().decode()
-        return StatWebSubProIndex(content)
+        content = self._fetch(url)
+        return StatWebSubProIndex(content, store=self._create_index_store())
 
     def create_package_dict(self, guid, content):
-        metadata = StatWebMetadataSubPro(str=content)
+        metadata = StatWebMetadataSubPro(txt=content)
         package_dict = mapping.create_subpro_package_dict(guid, metadata, self.source_config)
         return package_dict, metadata
 
     def fetch_stage(self, harvest_object):
         return True
 
-    def attach_resources(self, metadata, package_dict):
+    def attach_resources(self, metadata, package_dict, harvest_object):
 
         for resource_key in ["URLIndicatore"]:
             json_resource_url = metadata.get(resource_key)
             if not json_resource_url:
                 continue
 
-            self._attach_data_resources(json_resource_url, package_dict)
+            self._attach_data_resources(json_resource_url, package_dict, harvest_object)
 
         for md_resource_key in ["URLTabDenMD", "URLTabNumMD"]:
             md_resource_url = metadata.get(md_resource_key)
@@ -82,38 +84,42 @@ class StatWebSubProHarvester(StatWebBaseHarvester, SingletonPlugin):
                 continue
 
             log.debug('Attaching MD resources to "%s"', metadata.get_descrizione() )
-            self._attach_md_resources(md_resource_url, package_dict)
+            self._attach_md_resources(md_resource_url, package_dict, harvest_object)
 
 
-    def _attach_md_resources(self, md_resource_url, package_dict):
-        rmd = requests.get(md_resource_url)
-        if not rmd.ok:
-            log.warn('StatWebSubPro error loading resource metadata %s for guid %s', md_resource_url, harvest_object.guid)
+    def _attach_md_resources(self, md_resource_url, package_dict, harvest_object):
+        try:
+            content = self._fetch(md_resource_url)
+        except Exception as e:
+            self._record_url_failure(harvest_object, md_resource_url, e)
             return
 
-        if not rmd.content:
-            log.warn('Empty json at resource URL %s', md_resource_url)
+        if not content:
+            log.warning('Empty json at resource URL %s', md_resource_url)
             return
 
         try:
-            spmd = SubProMetadata(str=rmd.content)
+            spmd = SubProMetadata(str=content)
             log.debug('Attaching resource "%s"', spmd.get_descrizione())
-            self._attach_data_resources(spmd.get_data_url(), package_dict)
+            self._attach_data_resources(spmd.get_data_url(), package_dict, harvest_object)
         except ValueError as e:
-            log.warn('Error decoding json\n URL: %s\njson: "%s"', rmd.content)
+            log.warning('Error decoding json\n URL: %s\njson: "%s"', md_resource_url, content)
 
 
-    def _attach_data_resources(self, json_resource_url, package_dict):
+    def _attach_data_resources(self, json_resource_url, package_dict, harvest_object):
         """
         Attach the JSON resource and the related CSV resource
         """
 
-        rdata = requests.get(json_resource_url)
-        if not rdata.ok:
-            log.warn('StatWebSubPro error loading json resource at %s', json_resource_url)
+        try:
+            rdata = self._fetch(json_resource_url)
+            robj = _safe_decode(rdata)
+            res_title = list(robj.keys())[0]
+        except Exception as e:
+            self._record_url_failure(harvest_object, json_resource_url, e)
             return
 
-        res_title = rdata.json().keys()[0]
+        self._store_snapshot(json_resource_url, rdata, robj)
 
         res_dict_json = {
             'name': res_title,
@@ -138,5 +144,6 @@ class StatWebSubProHarvester(StatWebBaseHarvester, SingletonPlugin):
             'resource_type': 'file',
 #                'last_modified': modified,
         }
+        self._set_datastore_digest(res_dict_csv, rdata)
         package_dict['resources'].append(res_dict_csv)
             
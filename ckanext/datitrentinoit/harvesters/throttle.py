@@ -0,0 +1,323 @@
+import email.utils
+import logging
+import threading
+import time
+from urllib.parse import urlparse
+
+from ckan.lib.base import config
+
+log = logging.getLogger(__name__)
+
+CONFIG_THROTTLE_RATE = 'ckanext.datitrentinoit.throttle.rate'
+CONFIG_THROTTLE_MAX_RATE = 'ckanext.datitrentinoit.throttle.max_rate'
+CONFIG_THROTTLE_MAX_CONCURRENCY = 'ckanext.datitrentinoit.throttle.max_concurrency'
+CONFIG_THROTTLE_LATENCY_TARGET = 'ckanext.datitrentinoit.throttle.latency_target'
+DEFAULT_THROTTLE_RATE = 5.0
+DEFAULT_THROTTLE_MAX_RATE = 20.0
+DEFAULT_THROTTLE_MAX_CONCURRENCY = 8
+DEFAULT_THROTTLE_LATENCY_TARGET = 2.0
+CONFIG_THROTTLE_STATS_INTERVAL = 'ckanext.datitrentinoit.throttle.stats_interval'
+DEFAULT_THROTTLE_STATS_INTERVAL = 300
+CONFIG_THROTTLE_MAX_RETRY_AFTER = 'ckanext.datitrentinoit.throttle.max_retry_after'
+DEFAULT_THROTTLE_MAX_RETRY_AFTER = 300
+
+CONFIG_CIRCUIT_FAILURES = 'ckanext.datitrentinoit.circuit.failures'
+CONFIG_CIRCUIT_COOLDOWN = 'ckanext.datitrentinoit.circuit.cooldown'
+DEFAULT_CIRCUIT_FAILURES = 5
+DEFAULT_CIRCUIT_COOLDOWN = 60
+
+MIN_RATE = 0.2
+MIN_CONCURRENCY = 1
+# weight of the last request in the latency moving average
+LATENCY_EWMA_WEIGHT = 0.2
+
+
+class HostBlockedError(Exception):
+    pass
+
+
+class HostThrottle(object):
+    '''
+    Limits the requests sent to a single host with a token bucket (requests
+    per second) and a max number of concurrent requests.
+
+    Both limits are adapted (additive increase, multiplicative decrease):
+    they are halved when a request fails with a server error or the average
+    latency exceeds the target, and increased after a streak of healthy
+    requests. A Retry-After from the server blocks the host until it expires;
+    requests are only kept waiting for up to `max_retry_after` seconds, a
+    longer block makes them fail with HostBlockedError.
+    '''
+
+    def __init__(self, host, rate=DEFAULT_THROTTLE_RATE, max_rate=DEFAULT_THROTTLE_MAX_RATE,
+                 max_concurrency=DEFAULT_THROTTLE_MAX_CONCURRENCY, latency_target=DEFAULT_THROTTLE_LATENCY_TARGET,
+                 max_retry_after=DEFAULT_THROTTLE_MAX_RETRY_AFTER):
+        self.host = host
+        self.rate = min(rate, max_rate)
+        self.max_rate = max_rate
+        self.max_concurrency = max_concurrency
+        self.concurrency = max(MIN_CONCURRENCY, min(2, max_concurrency))
+        self.latency_target = latency_target
+        self.max_retry_after = max_retry_after
+
+        self.latency = None
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.blocked_until = 0
+
+        self._tokens = 1.0
+        self._refilled_at = time.monotonic()
+        self._streak = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        '''
+        Blocks until a request can be sent to the host
+
+        :raise HostBlockedError: if the host asked to wait longer than `max_retry_after`
+        '''
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self.blocked_until - now > self.max_retry_after:
+                    raise HostBlockedError(f'{self.host} is blocked for {self.blocked_until - now:.0f}s '
+                                           f'by a Retry-After')
+                if now < self.blocked_until:
+                    self._cond.wait(self.blocked_until - now)
+                    continue
+
+                self._tokens = min(max(1.0, self.rate), self._tokens + (now - self._refilled_at) * self.rate)
+                self._refilled_at = now
+
+                if self.in_flight < self.concurrency and self._tokens >= 1:
+                    self._tokens -= 1
+                    self.in_flight += 1
+                    return
+
+                if self._tokens < 1:
+                    self._cond.wait((1 - self._tokens) / self.rate)
+                else:
+                    self._cond.wait()
+
+    def release(self, latency, error=False, retry_after=None):
+        '''
+        Records the outcome of a request sent after acquire()
+
+        :param latency: seconds the request took
+        :param error: True if the server failed or refused the request
+        :param retry_after: seconds the server asked to wait before the next request
+        '''
+        with self._cond:
+            self.in_flight -= 1
+            self.requests += 1
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += LATENCY_EWMA_WEIGHT * (latency - self.latency)
+
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+                log.info('%s asked to retry after %ss', self.host, retry_after)
+
+            if error or retry_after or self.latency > self.latency_target:
+                if error:
+                    self.errors += 1
+                self._decrease()
+            else:
+                self._streak += 1
+                if self._streak >= self.concurrency:
+                    self._increase()
+
+            self._cond.notify_all()
+
+    def _decrease(self):
+        self._streak = 0
+        rate, concurrency = self.rate, self.concurrency
+        self.rate = max(MIN_RATE, self.rate / 2)
+        self.concurrency = max(MIN_CONCURRENCY, self.concurrency // 2)
+        if (rate, concurrency) != (self.rate, self.concurrency):
+            log.info('Throttling %s: %.1f req/s, %d concurrent (latency %.2fs, %d errors)',
+                     self.host, self.rate, self.concurrency, self.latency, self.errors)
+
+    def _increase(self):
+        self._streak = 0
+        self.rate = min(self.max_rate, self.rate + 1)
+        self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+        log.debug('Speeding up %s: %.1f req/s, %d concurrent', self.host, self.rate, self.concurrency)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'host': self.host,
+                'rate': round(self.rate, 2),
+                'concurrency': self.concurrency,
+                'in_flight': self.in_flight,
+                'latency': round(self.latency, 3) if self.latency is not None else None,
+                'requests': self.requests,
+                'errors': self.errors,
+                'blocked_for': round(max(0, self.blocked_until - time.monotonic()), 1),
+            }
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    '''
+    Fails fast the requests toward a host that keeps failing.
+
+    After `max_failures` consecutive host failures (connection errors,
+    timeouts, server errors) the circuit opens and requests are refused for
+    `cooldown` seconds; then a single trial request is let through, and its
+    outcome closes the circuit or opens it again.
+    '''
+
+    def __init__(self, host, max_failures=DEFAULT_CIRCUIT_FAILURES, cooldown=DEFAULT_CIRCUIT_COOLDOWN):
+        self.host = host
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def check(self):
+        '''
+        :raise CircuitOpenError: if no request should be sent to the host now
+        '''
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if self._trial or time.monotonic() - self.opened_at < self.cooldown:
+                raise CircuitOpenError(f'Circuit open for {self.host} after {self.failures} failures')
+            # half open: let a single request through
+            self._trial = True
+
+    def success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                log.info('Circuit closed for %s', self.host)
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def cancel(self):
+        '''
+        Gives back the trial granted by check() to a request which was not sent
+        '''
+        with self._lock:
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or (self.opened_at is None and self.failures >= self.max_failures):
+                log.warning('Circuit open for %s after %d failures', self.host, self.failures)
+                self.opened_at = time.monotonic()
+            self._trial = False
+
+    def is_open(self):
+        with self._lock:
+            return self.opened_at is not None
+
+
+_throttles = {}  # host: HostThrottle
+_breakers = {}  # host: CircuitBreaker
+_throttles_lock = threading.Lock()
+_stats_logged_at = None
+
+
+def get_throttle(url):
+    '''
+    :return: the HostThrottle shared by all the requests to the host of the given URL
+    '''
+    log_throttle_stats()
+    host = urlparse(url).netloc
+    with _throttles_lock:
+        throttle = _throttles.get(host)
+        if throttle is None:
+            throttle = _throttles[host] = HostThrottle(
+                host,
+                rate=float(config.get(CONFIG_THROTTLE_RATE, DEFAULT_THROTTLE_RATE)),
+                max_rate=float(config.get(CONFIG_THROTTLE_MAX_RATE, DEFAULT_THROTTLE_MAX_RATE)),
+                max_concurrency=int(config.get(CONFIG_THROTTLE_MAX_CONCURRENCY, DEFAULT_THROTTLE_MAX_CONCURRENCY)),
+                latency_target=float(config.get(CONFIG_THROTTLE_LATENCY_TARGET, DEFAULT_THROTTLE_LATENCY_TARGET)),
+                max_retry_after=float(config.get(CONFIG_THROTTLE_MAX_RETRY_AFTER, DEFAULT_THROTTLE_MAX_RETRY_AFTER)))
+        return throttle
+
+
+def get_circuit_breaker(url):
+    '''
+    :return: the CircuitBreaker shared by all the requests to the host of the given URL
+    '''
+    host = urlparse(url).netloc
+    with _throttles_lock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = _breakers[host] = CircuitBreaker(
+                host,
+                max_failures=int(config.get(CONFIG_CIRCUIT_FAILURES, DEFAULT_CIRCUIT_FAILURES)),
+                cooldown=float(config.get(CONFIG_CIRCUIT_COOLDOWN, DEFAULT_CIRCUIT_COOLDOWN)))
+        return breaker
+
+
+def get_throttle_stats():
+    '''
+    :return: the current limits and counters of every throttled host
+    '''
+    with _throttles_lock:
+        throttles = list(_throttles.values())
+        breakers = dict(_breakers)
+    stats = []
+    for throttle in throttles:
+        throttle_stats = throttle.stats()
+        breaker = breakers.get(throttle.host)
+        throttle_stats['circuit_open'] = breaker.is_open() if breaker else False
+        stats.append(throttle_stats)
+    return stats
+
+
+def log_throttle_stats(force=False):
+    '''
+    Logs the current limits of every throttled host, at most once every
+    `ckanext.datitrentinoit.throttle.stats_interval` seconds, so that the
+    limits of the gather and fetch workers can be followed in their logs.
+    '''
+    global _stats_logged_at
+    interval = float(config.get(CONFIG_THROTTLE_STATS_INTERVAL, DEFAULT_THROTTLE_STATS_INTERVAL))
+    now = time.monotonic()
+    with _throttles_lock:
+        if not force and (interval <= 0 or
+                          (_stats_logged_at is not None and now - _stats_logged_at < interval)):
+            return
+        # the first call only starts the interval
+        due = force or _stats_logged_at is not None
+        _stats_logged_at = now
+    if not due:
+        return
+
+    for stats in get_throttle_stats():
+        log.info('Throttle stats for %s: %.1f req/s, %d concurrent, %d in flight, latency %ss, '
+                 '%d requests, %d errors, blocked for %ss, circuit %s',
+                 stats['host'], stats['rate'], stats['concurrency'], stats['in_flight'], stats['latency'],
+                 stats['requests'], stats['errors'], stats['blocked_for'],
+                 'open' if stats['circuit_open'] else 'closed')
+
+
+def parse_retry_after(value):
+    '''
+    :return: the seconds to wait according to a Retry-After header (delay or HTTP date), or None
+    '''
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
@@ -8,18 +8,70 @@ import ckan.lib.helpers as h
 
 import ckan.logic as logic
 from ckan.common import request
+from ckan.lib.base import config
+
+from sqlalchemy import func
 
 import ckanext.multilang.helpers as multilang_helpers
 
 from ckanext.multilang.model import PackageMultilang
 
+from ckanext.datitrentinoit.cache import TTLCache
+
 log = logging.getLogger(__file__)
 
 
+# dataset fields translated in PackageMultilang which are indexed in Solr
+LOCALIZED_FIELDS = ('title', 'notes')
+# key of the localized fields in the indexed dataset dict
+LOCALIZED_FIELDS_KEY = 'localized_fields'
+# pages whose dataset lists are shown in the language of the user; the
+# search results are left untranslated elsewhere (API, DCAT endpoints...)
+LOCALIZED_SEARCH_ENDPOINTS = ('dataset.search', 'organization.read', 'group.read', 'home.index',
+                              'datitrentinoit.latest_changes')
+
+CONFIG_RECENT_UPDATES_TTL = 'ckanext.datitrentinoit.recent_updates.cache_ttl'
+DEFAULT_RECENT_UPDATES_TTL = 300
+
+# (lang, n, last metadata_modified): list of the most recently updated datasets
+_recent_updates_cache = TTLCache(DEFAULT_RECENT_UPDATES_TTL, max_entries=50)
+
+
 def recent_updates(n):
     #
     # Return a list of the n most recently updated datasets.
     #
+    # Results are cached per language and keyed by the last metadata_modified
+    # of the packages, so that changes made by other processes (e.g. the
+    # bulk deletes of the harvesters) are picked up; they are also
+    # invalidated when a dataset is created, updated or deleted (see
+    # DatiTrentinoPlugin)
+    lang = multilang_helpers.getLanguage()
+    ttl = int(config.get(CONFIG_RECENT_UPDATES_TTL, DEFAULT_RECENT_UPDATES_TTL))
+    key = (lang, n, _last_metadata_modified())
+
+    results = _recent_updates_cache.get(key)
+    if results is None:
+        results = _search_recent_updates(n)
+        if results is None:
+            return []
+        _recent_updates_cache.set(key, results, ttl=ttl)
+
+    return list(results)
+
+
+def invalidate_recent_updates():
+    _recent_updates_cache.clear()
+
+
+def _last_metadata_modified():
+    return model.Session.query(func.max(model.Package.metadata_modified)).scalar()
+
+
+def _search_recent_updates(n):
+    '''
+    :return: the n most recently updated datasets, or None if the search failed
+    '''
     log.debug('::::: Retrieving latest datasets: %r' % n)
     context = {'model': model,
                'session': model.Session,
@@ -34,20 +86,48 @@ def recent_updates(n):
     except search.SearchError as e:
         log.error('Error searching for recently updated datasets')
         log.error(e)
-        search_results = {}
+        return None
 
-    for item in search_results.get('results'):
-        log.info(':::::::::::: Retrieving the corresponding localized title and abstract :::::::::::::::')
+    # the localized titles and abstracts are indexed, and applied by
+    # DatiTrentinoPlugin.after_search
+    return search_results.get('results', [])
 
-        lang = multilang_helpers.getLanguage()
 
-        q_results = model.Session.query(PackageMultilang)\
-                                 .filter(PackageMultilang.package_id == item.get('id'),
-                                         PackageMultilang.lang == lang).all()
+def get_localized_fields(package_id):
+    '''
+    :return: {field: {lang: text}} of the localized title and notes of a dataset
+    '''
+    localized = {}
+    q_results = model.Session.query(PackageMultilang.field, PackageMultilang.lang, PackageMultilang.text)\
+                             .filter(PackageMultilang.package_id == package_id,
+                                     PackageMultilang.field.in_(LOCALIZED_FIELDS))
+    for field, lang, text in q_results:
+        if text:
+            localized.setdefault(field, {})[lang] = text
+    return localized
 
-        if q_results:
-            for result in q_results:
-                item[result.field] = result.text
 
-    return search_results.get('results', [])
+def get_search_language():
+    '''
+    :return: the language of the localized fields in the search results, or
+             None outside of the dataset list pages (LOCALIZED_SEARCH_ENDPOINTS)
+    '''
+    try:
+        if request.endpoint not in LOCALIZED_SEARCH_ENDPOINTS:
+            return None
+    except (RuntimeError, TypeError, AttributeError):
+        return None
+    return multilang_helpers.getLanguage()
+
 
+def localize_package(package, lang):
+    '''
+    Replaces title and notes of a search result with the ones in the given
+    language, as stored in the search index (see get_localized_fields).
+    With no language the package is left untranslated.
+    '''
+    localized = package.pop(LOCALIZED_FIELDS_KEY, None) or {}
+    for field, texts in localized.items():
+        if lang and lang in texts:
+            package[field] = texts[lang]
+    return package
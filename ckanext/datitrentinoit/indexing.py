@@ -0,0 +1,123 @@
+import datetime
+import json
+import logging
+
+from ckan.common import asbool
+from ckan.lib.base import config
+
+log = logging.getLogger(__name__)
+
+# the typed fields need the Solr schema changes listed in the README
+CONFIG_TYPED_INDEX_FIELDS = 'ckanext.datitrentinoit.search.typed_fields'
+
+SOLR_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+DATE_FORMATS = ('%Y-%m-%d', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M:%S.%f', '%d-%m-%Y', '%d/%m/%Y', '%Y')
+
+
+def typed_index_fields_enabled():
+    return asbool(config.get(CONFIG_TYPED_INDEX_FIELDS, False))
+
+
+def typed_index_fields(pkg_dict):
+    '''
+    Parses the DCAT-AP_IT extras set by the harvesters (and by the dcatapit
+    forms) into typed search index fields:
+    - temporal_start_date, temporal_end_date: bounds of the temporal coverage
+    - temporal_start_year, temporal_end_year: the same bounds as years
+    - modified_date, issued_date
+    - frequency_code
+    - theme_codes: the codes of the themes
+
+    :return: a dict of the fields that could be parsed
+    '''
+    fields = {}
+
+    start, end = _temporal_bounds(pkg_dict)
+    if start:
+        fields['temporal_start_date'] = start.strftime(SOLR_DATE_FORMAT)
+        fields['temporal_start_year'] = start.year
+    if end:
+        fields['temporal_end_date'] = end.strftime(SOLR_DATE_FORMAT)
+        fields['temporal_end_year'] = end.year
+
+    for key in ('modified', 'issued'):
+        value = _parse_date(_get_value(pkg_dict, key))
+        if value:
+            fields[key + '_date'] = value.strftime(SOLR_DATE_FORMAT)
+
+    frequency = _get_value(pkg_dict, 'frequency')
+    if frequency and isinstance(frequency, str):
+        fields['frequency_code'] = frequency.strip().upper()
+
+    themes = _theme_codes(pkg_dict)
+    if themes:
+        fields['theme_codes'] = themes
+
+    return fields
+
+
+def _get_value(pkg_dict, key):
+    '''
+    The dcatapit fields are either top level keys or extras, depending on the schema the dict was built with
+    '''
+    value = pkg_dict.get(key)
+    if value in (None, ''):
+        value = pkg_dict.get('extras_' + key)
+    return value
+
+
+def _get_json_value(pkg_dict, key):
+    value = _get_value(pkg_dict, key)
+    if isinstance(value, str):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return None
+    return value
+
+
+def _parse_date(value):
+    if not value or not isinstance(value, str):
+        return None
+    value = value.strip()
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    log.debug('Could not parse date "%s"', value)
+    return None
+
+
+def _temporal_bounds(pkg_dict):
+    '''
+    :return: the earliest start and the latest end of the temporal coverage intervals
+    '''
+    intervals = _get_json_value(pkg_dict, 'temporal_coverage')
+    if not isinstance(intervals, list):
+        intervals = []
+    intervals = [i for i in intervals if isinstance(i, dict)]
+    if not intervals:
+        intervals = [{'temporal_start': _get_value(pkg_dict, 'temporal_start'),
+                      'temporal_end': _get_value(pkg_dict, 'temporal_end')}]
+
+    starts = [d for d in (_parse_date(i.get('temporal_start')) for i in intervals) if d]
+    ends = [d for d in (_parse_date(i.get('temporal_end')) for i in intervals) if d]
+    return (min(starts) if starts else None), (max(ends) if ends else None)
+
+
+def _theme_codes(pkg_dict):
+    themes = _get_json_value(pkg_dict, 'themes_aggregate')
+    if isinstance(themes, list):
+        codes = [t.get('theme') for t in themes if isinstance(t, dict)]
+    else:
+        # legacy dcatapit format: {CODE1,CODE2}
+        value = _get_value(pkg_dict, 'theme')
+        codes = value.strip('{}').split(',') if isinstance(value, str) else []
+
+    unique = []
+    for code in codes:
+        code = (code or '').strip()
+        if code and code not in unique:
+            unique.append(code)
+    return unique
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class MemoryIndexStore(object):
+    '''
+    Keeps the serialized index entries in a dict.
+    '''
+
+    def __init__(self):
+        self._entries = {}  # guid: serialized entry
+
+    def put(self, guid, content):
+        self._entries[guid] = content
+
+    def get(self, guid):
+        return self._entries[guid]
+
+    def keys(self):
+        return set(self._entries.keys())
+
+    def items(self):
+        return iter(self._entries.items())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def close(self):
+        self._entries = {}
+
+
+class SqliteIndexStore(object):
+    '''
+    Keeps the serialized index entries in a SQLite db created in a temp dir,
+    which is removed on close().
+    Reads can be performed from multiple threads.
+    '''
+
+    def __init__(self, basedir=None):
+        self._dir = tempfile.mkdtemp(prefix='dti_index_', dir=basedir)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(self._dir, 'index.db'), check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=OFF')
+        self._conn.execute('PRAGMA synchronous=OFF')
+        self._conn.execute('CREATE TABLE entries (guid TEXT PRIMARY KEY, content TEXT)')
+
+    def put(self, guid, content):
+        self._conn.execute('INSERT OR REPLACE INTO entries (guid, content) VALUES (?, ?)', (guid, content))
+
+    def put_many(self, items):
+        self._conn.executemany('INSERT OR REPLACE INTO entries (guid, content) VALUES (?, ?)', items)
+
+    def get(self, guid):
+        with self._lock:
+            row = self._conn.execute('SELECT content FROM entries WHERE guid = ?', (guid,)).fetchone()
+        if row is None:
+            raise KeyError(guid)
+        return row[0]
+
+    def keys(self):
+        return {row[0] for row in self._conn.execute('SELECT guid FROM entries')}
+
+    def items(self):
+        return iter(self._conn.execute('SELECT guid, content FROM entries'))
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+
+class SpillingIndexStore(object):
+    '''
+    Starts as an in-memory store and moves all the entries into a SQLite store
+    once more than `threshold` entries have been added.
+    A threshold of 0 or None never spills.
+    '''
+
+    def __init__(self, threshold=None, basedir=None):
+        self._threshold = threshold
+        self._basedir = basedir
+        self._store = MemoryIndexStore()
+        self._spilled = False
+
+    def put(self, guid, content):
+        self._store.put(guid, content)
+        if not self._spilled and self._threshold and len(self._store) > self._threshold:
+            self._spill()
+
+    def _spill(self):
+        log.info('Index exceeds %s entries, spilling to disk', self._threshold)
+        disk_store = SqliteIndexStore(basedir=self._basedir)
+        disk_store.put_many(self._store.items())
+        self._store.close()
+        self._store = disk_store
+        self._spilled = True
+
+    def is_spilled(self):
+        return self._spilled
+
+    def get(self, guid):
+        return self._store.get(guid)
+
+    def keys(self):
+        return self._store.keys()
+
+    def items(self):
+        return self._store.items()
+
+    def __len__(self):
+        return len(self._store)
+
+    def close(self):
+        self._store.close()
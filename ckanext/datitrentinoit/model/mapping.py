@@ -3,9 +3,14 @@
 import json
 import logging
 import datetime
+import threading
+import time
 import uuid
 from hashlib import sha1
 
+from ckan.lib.base import config
+from ckan.model.system_info import get_system_info, set_system_info
+
 from ckanext.dcatapit.commands.vocabulary import FREQUENCIES_THEME_NAME
 from ckanext.dcatapit.helpers import get_vocabulary_items
 from ckanext.dcatapit.model import License
@@ -306,21 +311,158 @@ def parse_ultimo_aggiornamento(metadata):
     return datetime.datetime(year, month, day)
 
 
-_CACHED_FREQS = None
-def _get_freqs():
+# Frequency labels found in legacy metadata, in IT/EN/DE, mapped onto the
+# dcatapit frequency codes (see also migration/sql/migration.sql).
+# They are always indexed, so that lookups work even when the vocabulary is
+# not loaded yet.
+FREQ_LEGACY_LABELS = {
+    'IRREG': ['asneeded', 'se necessario', 'falls erforderlich',
+              'unplanned', 'non pianificato', 'ungeplant',
+              'not expected', 'non previsto', 'nicht zu erwarten',
+              'irregular', 'irregolare', 'irregulär'],
+    'QUARTERLY': ['quarterly', 'quartale', 'trimestrale', 'vierteljährlich'],
+    'BIWEEKLY': ['fortnightly', 'stagionale', 'saisonal'],
+    'ANNUAL': ['annually', 'annuale', 'jährlich'],
+    'BIENNIAL': ['biannually', 'biennale', 'zweijährlich'],
+    'TRIENNIAL': ['three-year', 'triennale'],
+    'MONTHLY': ['monthly', 'mensile', 'monatlich'],
+    'WEEKLY': ['weekly', 'settimanale', 'wöchentlich'],
+    'DAILY': ['daily', 'giornaliero', 'täglich'],
+    'UPDATE_CONT': ['continues', 'continua', 'weiter',
+                    'continual', 'continuo', 'dauer'],
+    'OTHER': ['four-monthly', 'quadrimestrale', 'vier-monats',
+              'half-yearly', 'semestrale', 'halbjährlich',
+              'hourly', 'orario', 'zeit',
+              'decennial', 'decennale', 'zehnjährig',
+              'constant dataset', 'dataset costante', 'konstante-datensatz',
+              'quinquennial', 'quinquennale', 'alle fünf jahre'],
+    'UNKNOWN': ['estemporaneo', 'undefined', 'non definito', 'undefiniert',
+                'notplanned', 'non programmato', 'unprogrammierten',
+                'unknown', 'sconosciuto', 'unbekannt',
+                '2013', ''],
+}
+
+FREQ_LANGS = ('it', 'en', 'de', 'fr')
+
+CONFIG_FREQ_TTL = 'ckanext.datitrentinoit.frequencies.ttl'
+DEFAULT_FREQ_TTL = 3600
+# retry delay used while the frequency vocabulary is still empty
+FREQ_RETRY_TTL = 60
+# system_info key changed by invalidate_frequencies(), to reload the mapping in all the processes
+FREQ_VERSION_KEY = 'datitrentinoit.frequencies_version'
+# seconds between two checks of FREQ_VERSION_KEY
+FREQ_VERSION_CHECK = 60
+
+
+class FrequencyLookup(object):
+    '''
+    Maps frequency labels (in any of the vocabulary languages, or legacy
+    variants) onto the dcatapit frequency codes.
+
+    The label index is built once for all languages and rebuilt when its TTL
+    expires, when `invalidate()` is called, or when the version stored in
+    system_info (see invalidate_frequencies) changes.
+    '''
+
+    def __init__(self, ttl=None):
+        self._ttl = ttl
+        self._index = None
+        self._expires_at = 0
+        self._version = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    def get(self, label):
+        if label is None:
+            return None
+        return self._get_index().get(label.strip().lower())
+
+    def invalidate(self):
+        with self._lock:
+            self._index = None
+            self._expires_at = 0
+
+    def _get_index(self):
+        index = self._index
+        now = time.monotonic()
+        if index is not None and now < self._expires_at and now < self._checked_at + FREQ_VERSION_CHECK:
+            return index
+
+        with self._lock:
+            now = time.monotonic()
+            if self._index is not None and now < self._expires_at:
+                if now < self._checked_at + FREQ_VERSION_CHECK:
+                    return self._index
+                self._checked_at = now
+                if _get_frequencies_version() == self._version:
+                    return self._index
+
+            self._version = _get_frequencies_version()
+            self._checked_at = now
+            self._index, ttl = self._load()
+            self._expires_at = time.monotonic() + ttl
+            return self._index
+
+    def _load(self):
+        index = {}
+        for code, labels in FREQ_LEGACY_LABELS.items():
+            for label in labels:
+                index[label] = code
+
+        loaded = 0
+        for lang in FREQ_LANGS:
+            try:
+                voc_items = get_vocabulary_items(vocabulary_name=FREQUENCIES_THEME_NAME, lang=lang)
+            except Exception as e:
+                log.warning(f'Could not load frequencies for lang "{lang}": {e}')
+                continue
+            for item in voc_items or []:
+                index[item['text'].strip().lower()] = item['value']
+                index[item['value'].lower()] = item['value']
+                loaded += 1
+
+        if loaded:
+            ttl = self._ttl if self._ttl is not None else int(config.get(CONFIG_FREQ_TTL, DEFAULT_FREQ_TTL))
+            log.info(f'Frequencies mapping loaded: {loaded} vocabulary labels, {len(index)} total')
+        else:
+            ttl = FREQ_RETRY_TTL
+            log.warning(f'Frequencies vocabulary not available, using legacy labels only for {ttl} seconds')
+
+        return index, ttl
+
+
+_FREQS = FrequencyLookup()
+
+
+def invalidate_frequencies():
     '''
-    :return: the vocabulary frequancies as a dict "lowercase italian label": "tag key"
+    Forces the reload of the frequencies mapping on next lookup, in this
+    process, and within FREQ_VERSION_CHECK seconds in the other ones
     '''
-    global _CACHED_FREQS
-    if _CACHED_FREQS is None:
-        log.info('Initializing Frequencies mapping')
-        voc_items = get_vocabulary_items(vocabulary_name=FREQUENCIES_THEME_NAME, lang='it')
+    set_system_info(FREQ_VERSION_KEY, uuid.uuid4().hex)
+    _FREQS.invalidate()
 
-        _CACHED_FREQS = {t['text'].lower():t['value'] for t in voc_items }
-        log.warning(f"Cached frequencies: {_CACHED_FREQS}")
 
-    return _CACHED_FREQS
+def _get_frequencies_version():
+    try:
+        return get_system_info(FREQ_VERSION_KEY)
+    except Exception as e:
+        log.warning(f'Could not read the frequencies version: {e}')
+        return None
+
+
+def frequency_migration_sql():
+    '''
+    :return: the SQL statements replacing the legacy frequency labels of the
+             datasets with the dcatapit codes, one per code
+    '''
+    statements = []
+    for code, labels in FREQ_LEGACY_LABELS.items():
+        values = ', '.join("'{0}'".format(label.replace("'", "''")) for label in labels)
+        statements.append(f"UPDATE package_extra SET value='{code}' "
+                          f"WHERE key='frequency' AND lower(value) IN ({values});")
+    return statements
 
 
 def _parse_freq(freq):
-    return _get_freqs().get(freq, None)
\ No newline at end of file
+    return _FREQS.get(freq)
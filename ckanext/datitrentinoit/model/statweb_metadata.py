@@ -3,6 +3,8 @@
 import json
 import logging
 
+from ckanext.datitrentinoit.model.index_store import MemoryIndexStore
+
 log = logging.getLogger(__name__)
 
 
@@ -10,13 +12,15 @@ class StatWebProIndex(object):
     '''
     Documento base di statweb, che contiene una lista delle info base
     (id e URL) dei dataset.
-    '''
 
-    entries = {}  # guid: StatWebProEntry
+    Le entry sono salvate serializzate nello store passato (in memoria di default);
+    lo store va rilasciato con close() al termine dell'harvest.
+    '''
 
-    def __init__(self, data):
+    def __init__(self, data, store=None):
         assert (data is not None), 'Index missing'
         assert (isinstance(data, str)), f'Index should be a string, found {type(data)}'
+        self.entries = store if store is not None else MemoryIndexStore()  # guid: serialized StatWebProEntry
         self.__parse(data)
 
     def __parse(self, data):
@@ -34,13 +38,22 @@ class StatWebProIndex(object):
                 continue
 
             entry = StatWebProEntry(obj=jsonentry)
-            self.entries[entry.build_guid()] = entry
+            self.entries.put(entry.build_guid(), entry.tostring())
 
     def keys(self):
-        return set(self.entries.keys())
+        return self.entries.keys()
 
     def get_as_string(self, guid):
-        return self.entries[guid].tostring()
+        return self.entries.get(guid)
+
+    def close(self):
+        self.entries.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 
 class StatWebProEntry(object):
@@ -223,12 +236,14 @@ class StatWebMetadataSubPro(StatWebMetadata):
 class StatWebSubProIndex(object):
     '''
     Documento base di statweb subpro, che contiene indice e contenuti subpro
-    '''
 
-    entries = {}  # id: StatWebMetadataSubPro
+    Le entry sono salvate serializzate nello store passato (in memoria di default);
+    lo store va rilasciato con close() al termine dell'harvest.
+    '''
 
-    def __init__(self, str):
+    def __init__(self, str, store=None):
         assert (str is not None), 'Index missing'
+        self.entries = store if store is not None else MemoryIndexStore()  # guid: serialized StatWebMetadataSubPro
         self.__parse(str)
 
     def __parse(self, str):
@@ -246,13 +261,22 @@ class StatWebSubProIndex(object):
                 continue
 
             entry = StatWebMetadataSubPro(obj=jsonentry)
-            self.entries[entry.build_guid()] = entry
+            self.entries.put(entry.build_guid(), entry.tostring())
 
     def keys(self):
-        return set(self.entries.keys())
+        return self.entries.keys()
 
     def get_as_string(self, guid):
-        return self.entries[guid].tostring()
+        return self.entries.get(guid)
+
+    def close(self):
+        self.entries.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 
 class SubProMetadata(object):
@@ -1,4 +1,5 @@
 import ckan.plugins as plugins
+import json
 import logging
 
 import ckan.lib.base as base
@@ -6,7 +7,11 @@ import ckan.plugins.toolkit as plugins_toolkit
 import routes.mapper as routes_mapper
 from flask import Blueprint
 
+import ckanext.datitrentinoit.actions as actions
+import ckanext.datitrentinoit.cli as cli
 import ckanext.datitrentinoit.helpers as helpers
+import ckanext.datitrentinoit.indexing as indexing
+import ckanext.datitrentinoit.views as views
 
 import ckanext.dcatapit.interfaces as interfaces
 
@@ -39,6 +44,12 @@ class DatiTrentinoPlugin(plugins.SingletonPlugin, DefaultTranslation):
     # IPackageController
     plugins.implements(plugins.IPackageController, inherit=True)
 
+    # IClick
+    plugins.implements(plugins.IClick)
+
+    # IActions
+    plugins.implements(plugins.IActions)
+
     # ICustomSchema
     plugins.implements(interfaces.ICustomSchema)
 
@@ -116,7 +127,7 @@ class DatiTrentinoPlugin(plugins.SingletonPlugin, DefaultTranslation):
         for page_name in static_pages:
             def get_action(name):
                 def action():
-                    return base.render('pages/{0}.html'.format(name))
+                    return views.static_page(name)
 
                 return action
 
@@ -126,8 +137,69 @@ class DatiTrentinoPlugin(plugins.SingletonPlugin, DefaultTranslation):
             page_slug = page_name.replace('_', '-')
             #             m.connect(page_name, '/' + page_slug, action=page_name)
             datitrentinoit.add_url_rule('/' + page_slug, page_name, view_func=action)
+
+        datitrentinoit.add_url_rule('/latest-changes', 'latest_changes', view_func=views.latest_changes)
+        datitrentinoit.add_url_rule('/dataset/<id>/resource/<resource_id>/snapshot', 'resource_snapshot',
+                                    view_func=views.resource_snapshot)
         return datitrentinoit
 
+    # Implementation of IPackageController
+    # ------------------------------------------------------------
+
+    def after_create(self, context, pkg_dict):
+        helpers.invalidate_recent_updates()
+
+    def after_update(self, context, pkg_dict):
+        helpers.invalidate_recent_updates()
+        actions.invalidate_package_show(pkg_dict['id'])
+
+    def after_delete(self, context, pkg_dict):
+        helpers.invalidate_recent_updates()
+        actions.invalidate_package_show(pkg_dict['id'])
+
+    def after_show(self, context, pkg_dict):
+        # package_show may serve the validated_data_dict stored in the search
+        # index, which holds the translations added in before_index
+        pkg_dict.pop(helpers.LOCALIZED_FIELDS_KEY, None)
+        return pkg_dict
+
+    def before_index(self, pkg_dict):
+        # index the localized title and notes as <field>_<lang>, and keep them
+        # in the indexed dataset dict so that search results can be localized
+        # without querying the DB
+        localized = helpers.get_localized_fields(pkg_dict['id'])
+        for field, texts in localized.items():
+            for lang, text in texts.items():
+                pkg_dict['{0}_{1}'.format(field, lang)] = text
+
+        if pkg_dict.get('validated_data_dict'):
+            validated_data_dict = json.loads(pkg_dict['validated_data_dict'])
+            validated_data_dict[helpers.LOCALIZED_FIELDS_KEY] = localized
+            pkg_dict['validated_data_dict'] = json.dumps(validated_data_dict)
+
+        # typed fields for the temporal coverage, dates, frequency and themes
+        if indexing.typed_index_fields_enabled():
+            pkg_dict.update(indexing.typed_index_fields(pkg_dict))
+        return pkg_dict
+
+    def after_search(self, search_results, search_params):
+        lang = helpers.get_search_language()
+        for package in search_results.get('results', []):
+            helpers.localize_package(package, lang)
+        return search_results
+
+    # Implementation of IActions
+    def get_actions(self):
+        return {
+            'package_show': actions.package_show,
+            'dcat_dataset_show': actions.dcat_dataset_show,
+            'dcat_catalog_show': actions.dcat_catalog_show,
+        }
+
+    # Implementation of IClick
+    def get_commands(self):
+        return cli.get_commands()
+
     # Implementation of ITemplateHelpers
     def get_helpers(self):
         return {
@@ -10,6 +10,9 @@ from ckanext.dcatapit.dcat.profiles import remove_unused_object
 
 DCATAPIT = Namespace('http://dati.gov.it/onto/dcatapit#')
 
+# bump when the output of the profile changes, to invalidate the cached RDF fragments
+PROFILE_VERSION = '1'
+
 log = logging.getLogger(__name__)
 
 
@@ -29,8 +32,8 @@ class DatitrentinoitProfile(RDFProfile):
         if contact_point_raw:
             try:
                 contact_points = json.loads(contact_point_raw)
-            except:
-                log.error(f"Can't decode contact_point [{contact_points}]")
+            except ValueError:
+                log.error(f"Can't decode contact_point [{contact_point_raw}]")
                 return
 
             if not isinstance(contact_points, list):
@@ -38,7 +41,7 @@ class DatitrentinoitProfile(RDFProfile):
                 return
 
             # Remove previous poc
-            for s, p, o in g.triples((dataset_ref, DCAT.contactPoint, None)):
+            for s, p, o in list(g.triples((dataset_ref, DCAT.contactPoint, None))):
                 log.info(f"Datitrentinoit Profile: Removing contactPoint {o}")
                 g.remove((s, p, o))
                 remove_unused_object(g, o, "contactPoint (DatiTrentinoIt)")
@@ -0,0 +1,154 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+from ckan.lib.base import config
+
+from ckanext.datitrentinoit.model.statweb_metadata import _safe_decode
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+log = logging.getLogger(__name__)
+
+CONFIG_SNAPSHOTS_DIR = 'ckanext.datitrentinoit.snapshots.dir'
+
+SNAPSHOT_EXT = '.arrow'
+LATEST_FILE = 'latest.json'
+
+
+def snapshots_enabled():
+    '''
+    Snapshots are stored only if a directory is configured and pyarrow is installed
+    '''
+    if not config.get(CONFIG_SNAPSHOTS_DIR):
+        return False
+    if pa is None:
+        log.warning('%s is set, but pyarrow is not installed', CONFIG_SNAPSHOTS_DIR)
+        return False
+    return True
+
+
+def url_key(url):
+    return hashlib.sha1(url.encode()).hexdigest()
+
+
+def _url_dir(url):
+    key = url_key(url)
+    return os.path.join(config.get(CONFIG_SNAPSHOTS_DIR), key[:2], key)
+
+
+def store_snapshot(url, content, obj=None):
+    '''
+    Stores a StatWeb indicator table (a JSON object with a single key, the
+    table title, holding the list of rows) as an Arrow IPC file, keyed by URL
+    and content digest. Nothing is written if the same content is already stored.
+
+    :param obj: the already decoded content, if available
+
+    :return: the snapshot info dict (see get_snapshot_info), or None if the content is not a table
+    '''
+    digest = hashlib.sha1(content.encode()).hexdigest()
+    url_dir = _url_dir(url)
+    info = get_snapshot_info(url)
+    if info and info['digest'] == digest:
+        return info
+
+    table = _to_table(obj if obj is not None else _safe_decode(content))
+    if table is None:
+        return None
+
+    os.makedirs(url_dir, exist_ok=True)
+    path = os.path.join(url_dir, digest + SNAPSHOT_EXT)
+    fd, tmp_path = tempfile.mkstemp(dir=url_dir, suffix='.tmp')
+    os.close(fd)
+    try:
+        with pa.OSFile(tmp_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+    info = {
+        'url': url,
+        'digest': digest,
+        'file': os.path.basename(path),
+        'rows': table.num_rows,
+        'columns': table.column_names,
+        'title': table.schema.metadata[b'title'].decode() if table.schema.metadata else None,
+    }
+    _write_json(os.path.join(url_dir, LATEST_FILE), info)
+
+    # remove the snapshots of previous contents
+    for name in os.listdir(url_dir):
+        if name.endswith(SNAPSHOT_EXT) and name != info['file']:
+            os.remove(os.path.join(url_dir, name))
+
+    log.debug('Stored snapshot of %s (%d rows)', url, table.num_rows)
+    return info
+
+
+def get_snapshot_info(url):
+    '''
+    :return: a dict with url, digest, file, rows, columns and title of the latest snapshot, or None
+    '''
+    if not config.get(CONFIG_SNAPSHOTS_DIR):
+        return None
+    try:
+        with open(os.path.join(_url_dir(url), LATEST_FILE)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def get_snapshot_path(url):
+    info = get_snapshot_info(url)
+    if not info:
+        return None
+    path = os.path.join(_url_dir(url), info['file'])
+    return path if os.path.exists(path) else None
+
+
+def load_snapshot(url):
+    '''
+    :return: the snapshot as a pyarrow Table backed by a memory map of the file, or None
+    '''
+    path = get_snapshot_path(url)
+    if path is None or pa is None:
+        return None
+    with pa.memory_map(path, 'r') as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+def _to_table(obj):
+    if not isinstance(obj, dict) or len(obj) != 1:
+        return None
+    title, rows = next(iter(obj.items()))
+    if not isinstance(rows, list):
+        return None
+    rows = [row for row in rows if isinstance(row, dict)]
+    metadata = {'title': str(title)}
+    try:
+        table = pa.Table.from_pylist(rows)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # mixed types in a column: keep everything as text
+        table = pa.Table.from_pylist([{k: None if v is None else str(v) for k, v in row.items()} for row in rows])
+    return table.replace_schema_metadata(metadata)
+
+
+def _write_json(path, obj):
+    # unique temporary file, the same URL may be stored by concurrent processes
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(obj, f)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
@@ -0,0 +1,55 @@
+import pytest
+
+from ckanext.datitrentinoit import cache
+from ckanext.datitrentinoit.cache import TTLCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_entries_expire_after_ttl(clock):
+    c = TTLCache(10)
+    c.set('a', 1)
+    clock[0] += 9
+    assert c.get('a') == 1
+    clock[0] += 1
+    assert c.get('a') is None
+    assert len(c) == 0
+
+
+def test_entry_ttl_overrides_default(clock):
+    c = TTLCache(10)
+    c.set('a', 1, ttl=60)
+    clock[0] += 30
+    assert c.get('a') == 1
+
+
+def test_non_positive_ttl_does_not_store():
+    c = TTLCache(0)
+    c.set('a', 1)
+    assert 'a' not in c
+
+
+def test_least_recently_used_entries_are_evicted():
+    c = TTLCache(60, max_entries=2)
+    c.set('a', 1)
+    c.set('b', 2)
+    c.get('a')
+    c.set('c', 3)
+    assert 'a' in c
+    assert 'b' not in c
+    assert 'c' in c
+
+
+def test_invalidate_if():
+    c = TTLCache(60)
+    c.set(('pkg1', 'it'), 1)
+    c.set(('pkg1', 'en'), 2)
+    c.set(('pkg2', 'it'), 3)
+    c.invalidate_if(lambda key: key[0] == 'pkg1')
+    assert len(c) == 1
+    assert c.get(('pkg2', 'it')) == 3
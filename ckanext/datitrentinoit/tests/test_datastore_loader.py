@@ -0,0 +1,190 @@
+import csv
+import io
+import json
+
+import pytest
+
+from ckanext.datitrentinoit.harvesters import datastore_loader as loader_module
+from ckanext.datitrentinoit.harvesters.datastore_loader import DatastoreLoader, _fitting_type, _infer_type
+
+RESOURCE = {'id': 'res-1', 'url': 'http://statweb.example/indicator/1?fmt=json', 'format': 'json'}
+
+
+class FakeDatastore(object):
+    '''
+    Records the statements sent to the datastore DB, and keeps the columns
+    and rows of a single table as they are committed
+    '''
+
+    def __init__(self, columns=None):
+        self.columns = columns or []  # [(name, postgres type)]
+        self.rows = []
+        self.statements = []
+        self.created = []
+        self.commits = 0
+        self.rollbacks = 0
+
+    def raw_connection(self):
+        return FakeConnection(self)
+
+
+class FakeConnection(object):
+
+    def __init__(self, db):
+        self.db = db
+        self.rows = list(db.rows)
+        # set when the columns are altered in the transaction
+        self.columns = None
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.db.commits += 1
+        self.db.rows = self.rows
+        if self.columns is not None:
+            self.db.columns = self.columns
+
+    def rollback(self):
+        self.db.rollbacks += 1
+
+    def close(self):
+        pass
+
+
+class FakeCursor(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._result = []
+
+    def execute(self, sql, params=None):
+        self.conn.db.statements.append(sql)
+        if sql.startswith('SELECT column_name'):
+            self._result = list(self.conn.db.columns if self.conn.columns is None else self.conn.columns)
+        elif sql.startswith('DELETE FROM'):
+            self.conn.rows = []
+        elif sql.startswith('ALTER TABLE'):
+            self.conn.columns = [tuple(change.split()[2:4]) for change in sql.split(', ') if 'ADD COLUMN' in change]
+
+    def fetchall(self):
+        return self._result
+
+    def copy_expert(self, sql, buf):
+        self.conn.rows.extend(csv.reader(io.StringIO(buf.getvalue())))
+
+
+@pytest.fixture
+def datastore(monkeypatch):
+    db = FakeDatastore()
+
+    def datastore_create(context, data_dict):
+        db.created.append(data_dict)
+        db.columns = [(f['id'], loader_module.PG_TYPES[f['type']]) for f in data_dict['fields']]
+        return data_dict
+
+    monkeypatch.setattr(loader_module, 'get_write_engine', lambda: db)
+    monkeypatch.setattr(loader_module, 'identifier', lambda name: name)
+    monkeypatch.setattr(loader_module.p.toolkit, 'get_action', lambda name: datastore_create)
+    return db
+
+
+@pytest.fixture
+def table(monkeypatch):
+    '''
+    The rows of the StatWeb JSON table served for RESOURCE
+    '''
+    rows = []
+    monkeypatch.setattr(loader_module, 'fetch', lambda url: json.dumps({'Indicator': rows}))
+    return rows
+
+
+@pytest.fixture
+def loader(monkeypatch):
+    loader = DatastoreLoader(chunk_rows=2)
+    monkeypatch.setattr(loader, 'loaded_digest', lambda resource_id: None)
+    return loader
+
+
+@pytest.mark.parametrize('values, expected', [
+    (['1', '-2', 3], 'int8'),
+    (['1', '2.5', '3,25', 1.5], 'numeric'),
+    (['1', 'n.d.'], 'text'),
+    (['', None], 'text'),
+    (['1', '', None], 'int8'),
+])
+def test_infer_type(values, expected):
+    assert _infer_type(values) == expected
+
+
+def test_fitting_type_is_never_narrower():
+    assert _fitting_type('12', 'int8') == 'int8'
+    assert _fitting_type('12,5', 'int8') == 'numeric'
+    assert _fitting_type('12', 'numeric') == 'numeric'
+    assert _fitting_type('n.d.', 'int8') == 'text'
+
+
+def test_new_table_is_created_and_loaded(loader, datastore, table):
+    table.extend([{'Anno': '2020', 'Valore': '1,5'}, {'Anno': '2021', 'Valore': '2'}, {'Anno': '2022'}])
+    assert loader.load({}, RESOURCE, 'digest-1') == 3
+
+    assert datastore.created[0]['fields'] == [{'id': 'Anno', 'type': 'int8'}, {'id': 'Valore', 'type': 'numeric'}]
+    assert datastore.rows == [['2020', '1.5'], ['2021', '2'], ['2022', '']]
+    assert any(s.startswith('COMMENT ON TABLE') for s in datastore.statements)
+
+
+def test_values_not_fitting_the_sample_widen_the_columns(monkeypatch, loader, datastore, table):
+    monkeypatch.setattr(loader_module, 'SAMPLE_ROWS', 2)
+    table.extend([{'Anno': '2020', 'Valore': '1'}, {'Anno': '2021', 'Valore': '2'},
+                  {'Anno': '2022', 'Valore': '2,5'}, {'Anno': 'totale', 'Valore': '3'}])
+    assert loader.load({}, RESOURCE, 'digest-1') == 4
+
+    # the first attempt is rolled back, the table is loaded again with the wider types
+    assert datastore.rollbacks == 1
+    assert datastore.columns == [('Anno', 'text'), ('Valore', 'numeric')]
+    assert datastore.rows == [['2020', '1'], ['2021', '2'], ['2022', '2.5'], ['totale', '3']]
+
+
+def test_current_table_is_not_loaded(monkeypatch, loader, datastore, table):
+    monkeypatch.setattr(loader, 'loaded_digest', lambda resource_id: 'digest-1')
+    assert loader.load({}, RESOURCE, 'digest-1') is None
+    assert datastore.statements == []
+
+
+def test_reload_replaces_the_rows(loader, datastore, table):
+    datastore.columns = [('Anno', 'bigint')]
+    datastore.rows = [['2019']]
+    table.extend([{'Anno': '2020'}, {'Anno': '2021'}])
+    assert loader.load({}, RESOURCE, 'digest-2') == 2
+
+    assert not datastore.created
+    assert not any(s.startswith('ALTER TABLE') for s in datastore.statements)
+    assert datastore.rows == [['2020'], ['2021']]
+
+
+def test_reload_with_new_columns_alters_the_table(loader, datastore, table):
+    datastore.columns = [('Anno', 'bigint')]
+    datastore.rows = [['2019']]
+    table.extend([{'Anno': '2020', 'Comune': 'Trento'}])
+    assert loader.load({}, RESOURCE, 'digest-2') == 1
+
+    assert not datastore.created
+    assert datastore.columns == [('Anno', 'int8'), ('Comune', 'text')]
+    assert datastore.rows == [['2020', 'Trento']]
+
+
+def test_failed_reload_keeps_the_previous_table(monkeypatch, loader, datastore, table):
+    datastore.columns = [('Anno', 'bigint')]
+    datastore.rows = [['2019']]
+    table.extend([{'Anno': '2020', 'Comune': 'Trento'}])
+
+    def copy_expert(self, sql, buf):
+        raise IOError('connection lost')
+
+    monkeypatch.setattr(FakeCursor, 'copy_expert', copy_expert)
+    with pytest.raises(IOError):
+        loader.load({}, RESOURCE, 'digest-2')
+
+    assert datastore.commits == 0
+    assert datastore.columns == [('Anno', 'bigint')]
+    assert datastore.rows == [['2019']]
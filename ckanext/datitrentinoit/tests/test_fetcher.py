@@ -0,0 +1,194 @@
+import io
+import threading
+from urllib.error import HTTPError, URLError
+
+import pytest
+
+from ckanext.datitrentinoit import cache
+from ckanext.datitrentinoit.harvesters import fetcher as fetcher_module
+from ckanext.datitrentinoit.harvesters.fetcher import CoalescingFetcher, FetchSkipped, MAX_RETRY_AFTER_ATTEMPTS
+from ckanext.datitrentinoit.harvesters.throttle import CircuitBreaker, HostThrottle
+
+URL = 'http://statweb.example/indicator/1'
+
+
+class FakeDownload(object):
+    '''
+    Replaces CoalescingFetcher._download, blocking until released
+    '''
+
+    def __init__(self, result='content', error=None):
+        self.result = result
+        self.error = error
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, url):
+        self.calls += 1
+        self.started.set()
+        self.release.wait(5)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def _fetch_in_threads(fetcher, count):
+    results = []
+
+    def target():
+        try:
+            results.append(fetcher.fetch(URL))
+        except Exception as e:
+            results.append(e)
+
+    threads = [threading.Thread(target=target) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+@pytest.fixture
+def fetcher():
+    return CoalescingFetcher(ttl=60, negative_ttl=60)
+
+
+def test_concurrent_callers_share_one_download(fetcher):
+    download = fetcher._download = FakeDownload()
+    download.release.clear()
+
+    leader, results = _fetch_in_threads(fetcher, 1)
+    assert download.started.wait(5)
+    waiters, results_waiters = _fetch_in_threads(fetcher, 5)
+    download.release.set()
+    for thread in leader + waiters:
+        thread.join(5)
+
+    assert download.calls == 1
+    assert results + results_waiters == ['content'] * 6
+    assert not fetcher._inflight
+
+
+def test_waiters_get_the_error_of_the_download(fetcher):
+    error = ValueError('broken table')
+    download = fetcher._download = FakeDownload(error=error)
+    download.release.clear()
+
+    leader, results = _fetch_in_threads(fetcher, 1)
+    assert download.started.wait(5)
+    waiters, results_waiters = _fetch_in_threads(fetcher, 3)
+    download.release.set()
+    for thread in leader + waiters:
+        thread.join(5)
+
+    assert download.calls == 1
+    assert results + results_waiters == [error] * 4
+
+
+def test_downloads_are_cached(fetcher):
+    download = fetcher._download = FakeDownload()
+    assert fetcher.fetch(URL) == 'content'
+    assert fetcher.fetch(URL) == 'content'
+    assert download.calls == 1
+
+    fetcher.invalidate(URL)
+    assert fetcher.fetch(URL) == 'content'
+    assert download.calls == 2
+
+
+@pytest.fixture
+def responses(monkeypatch):
+    '''
+    Serves the listed responses (exceptions or bodies) to the downloads
+    '''
+    responses = []
+    throttle = HostThrottle('statweb.example', rate=1000, max_rate=1000)
+    breaker = CircuitBreaker('statweb.example')
+    monkeypatch.setattr(fetcher_module, 'get_throttle', lambda url: throttle)
+    monkeypatch.setattr(fetcher_module, 'get_circuit_breaker', lambda url: breaker)
+
+    def urlopen(url, timeout=None):
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return io.BytesIO(response)
+
+    monkeypatch.setattr(fetcher_module.r, 'urlopen', urlopen)
+    return responses
+
+
+def _http_error(code, retry_after=None):
+    headers = {'Retry-After': retry_after} if retry_after is not None else {}
+    return HTTPError(URL, code, 'error', headers, None)
+
+
+def test_download_is_retried_after_retry_after(fetcher, responses):
+    responses.extend([_http_error(503, '0'), _http_error(429, '0'), b'content'])
+    assert fetcher.fetch(URL) == 'content'
+    assert not responses
+
+
+def test_retry_after_attempts_are_limited(fetcher, responses):
+    responses.extend([_http_error(503, '0')] * (MAX_RETRY_AFTER_ATTEMPTS + 2))
+    with pytest.raises(HTTPError):
+        fetcher.fetch(URL)
+    assert len(responses) == 1
+
+
+def test_retry_after_longer_than_the_max_skips_the_download(fetcher, responses):
+    responses.extend([_http_error(503, '3600'), b'content'])
+    with pytest.raises(FetchSkipped):
+        fetcher.fetch(URL)
+    # the host stays blocked, the following downloads are skipped too
+    with pytest.raises(FetchSkipped):
+        fetcher.fetch(URL)
+    assert len(responses) == 1
+
+
+def test_errors_without_retry_after_are_not_retried(fetcher, responses):
+    responses.extend([_http_error(503), b'content'])
+    with pytest.raises(HTTPError):
+        fetcher.fetch(URL)
+    assert len(responses) == 1
+
+
+def test_failed_urls_are_skipped_until_the_negative_ttl_expires(fetcher, clock):
+    download = fetcher._download = FakeDownload(error=URLError('connection refused'))
+    with pytest.raises(URLError):
+        fetcher.fetch(URL)
+
+    with pytest.raises(FetchSkipped):
+        fetcher.fetch(URL)
+    assert download.calls == 1
+
+    clock[0] += 60
+    download.error = None
+    assert fetcher.fetch(URL) == 'content'
+    assert download.calls == 2
+
+
+def test_skipped_downloads_are_not_negatively_cached(fetcher):
+    download = fetcher._download = FakeDownload(error=FetchSkipped('circuit open'))
+    with pytest.raises(FetchSkipped):
+        fetcher.fetch(URL)
+
+    download.error = None
+    assert fetcher.fetch(URL) == 'content'
+    assert download.calls == 2
+
+
+def test_open_circuit_skips_the_download(fetcher, responses):
+    breaker = fetcher_module.get_circuit_breaker(URL)
+    for _ in range(breaker.max_failures):
+        breaker.failure()
+    with pytest.raises(FetchSkipped):
+        fetcher.fetch(URL)
+    assert responses == []
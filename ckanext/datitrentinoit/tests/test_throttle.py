@@ -0,0 +1,128 @@
+import email.utils
+import time
+
+import pytest
+
+from ckanext.datitrentinoit.harvesters import throttle as throttle_module
+from ckanext.datitrentinoit.harvesters.throttle import CircuitBreaker, CircuitOpenError, HostBlockedError, \
+    HostThrottle, parse_retry_after
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(throttle_module.time, 'monotonic', lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def open_breaker(clock):
+    breaker = CircuitBreaker('statweb.example', max_failures=2, cooldown=60)
+    breaker.failure()
+    breaker.check()
+    breaker.failure()
+    return breaker
+
+
+def test_parse_retry_after_seconds():
+    assert parse_retry_after('120') == 120.0
+    assert parse_retry_after('-5') == 0.0
+
+
+def test_parse_retry_after_http_date():
+    value = email.utils.formatdate(time.time() + 60, usegmt=True)
+    assert 55 <= parse_retry_after(value) <= 60
+
+
+@pytest.mark.parametrize('value', [None, '', 'soon'])
+def test_parse_retry_after_invalid(value):
+    assert parse_retry_after(value) is None
+
+
+def test_retry_after_blocks_the_host():
+    throttle = HostThrottle('statweb.example', rate=100, max_rate=100)
+    throttle.acquire()
+    throttle.release(0.01, error=True, retry_after=0.3)
+    assert throttle.stats()['blocked_for'] > 0
+
+    start = time.monotonic()
+    throttle.acquire()
+    assert time.monotonic() - start >= 0.25
+    throttle.release(0.01)
+
+
+def test_retry_after_longer_than_the_max_fails_the_requests(clock):
+    throttle = HostThrottle('statweb.example', rate=100, max_rate=100, max_retry_after=60)
+    throttle.acquire()
+    throttle.release(0.01, error=True, retry_after=3600)
+    with pytest.raises(HostBlockedError):
+        throttle.acquire()
+
+    clock[0] += 3600
+    throttle.acquire()
+    throttle.release(0.01)
+
+
+def test_retry_after_reduces_the_limits():
+    throttle = HostThrottle('statweb.example', rate=8, max_rate=20, max_concurrency=8)
+    concurrency = throttle.concurrency
+    throttle.acquire()
+    throttle.release(0.01, retry_after=0.01)
+    assert throttle.rate == 4
+    assert throttle.concurrency == max(1, concurrency // 2)
+
+
+def test_breaker_opens_after_consecutive_failures(open_breaker):
+    assert open_breaker.is_open()
+    with pytest.raises(CircuitOpenError):
+        open_breaker.check()
+
+
+def test_breaker_success_resets_the_failures(clock):
+    breaker = CircuitBreaker('statweb.example', max_failures=2, cooldown=60)
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    assert not breaker.is_open()
+
+
+def test_breaker_lets_a_single_trial_through_after_cooldown(clock, open_breaker):
+    clock[0] += 59
+    with pytest.raises(CircuitOpenError):
+        open_breaker.check()
+
+    clock[0] += 1
+    open_breaker.check()
+    # the other requests are refused while the trial is in flight
+    with pytest.raises(CircuitOpenError):
+        open_breaker.check()
+
+
+def test_cancelled_trial_lets_another_one_through(clock, open_breaker):
+    clock[0] += 60
+    open_breaker.check()
+    open_breaker.cancel()
+    assert open_breaker.is_open()
+    open_breaker.check()
+
+
+def test_breaker_closes_on_trial_success(clock, open_breaker):
+    clock[0] += 60
+    open_breaker.check()
+    open_breaker.success()
+    assert not open_breaker.is_open()
+    open_breaker.check()
+    open_breaker.check()
+
+
+def test_breaker_opens_again_on_trial_failure(clock, open_breaker):
+    clock[0] += 60
+    open_breaker.check()
+    open_breaker.failure()
+    assert open_breaker.is_open()
+    with pytest.raises(CircuitOpenError):
+        open_breaker.check()
+
+    # a new cooldown starts from the failed trial
+    clock[0] += 60
+    open_breaker.check()
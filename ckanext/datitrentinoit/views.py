@@ -0,0 +1,154 @@
+import hashlib
+import json
+import logging
+import threading
+
+from flask import jsonify, make_response, request, send_file, session
+
+import ckan.lib.base as base
+import ckan.lib.helpers as h
+from ckan.lib.base import config
+import ckan.model as model
+import ckan.plugins.toolkit as plugins_toolkit
+
+import ckanext.datitrentinoit.helpers as helpers
+import ckanext.datitrentinoit.snapshots as snapshots
+
+log = logging.getLogger(__name__)
+
+SNAPSHOT_MAX_ROWS = 10000
+
+LATEST_CHANGES_ROWS = 20
+LATEST_CHANGES_MAX_ROWS = 50
+LATEST_CHANGES_MAX_AGE = 60
+
+CONFIG_STATIC_PAGES_MAX_AGE = 'ckanext.datitrentinoit.static_pages.max_age'
+DEFAULT_STATIC_PAGES_MAX_AGE = 3600
+
+# (page name, lang): (etag, rendered page); pages only change on deploy
+_static_pages = {}
+_static_pages_lock = threading.Lock()
+
+
+def resource_snapshot(id, resource_id):
+    '''
+    Serves the local columnar snapshot of a harvested StatWeb table, as an
+    Arrow IPC file or, with `format=json`, as a JSON list of rows (paged with
+    `offset` and `limit`).
+    '''
+    context = {'model': model, 'session': model.Session,
+               'user': plugins_toolkit.c.user, 'auth_user_obj': plugins_toolkit.c.userobj}
+    try:
+        resource = plugins_toolkit.get_action('resource_show')(context, {'id': resource_id})
+    except (plugins_toolkit.ObjectNotFound, plugins_toolkit.NotAuthorized):
+        return plugins_toolkit.abort(404, plugins_toolkit._('Resource not found'))
+    if id != resource['package_id']:
+        # the dataset may be given by name
+        package = model.Package.get(id)
+        if package is None or package.id != resource['package_id']:
+            return plugins_toolkit.abort(404, plugins_toolkit._('Resource not found'))
+
+    info = snapshots.get_snapshot_info(resource['url'])
+    path = snapshots.get_snapshot_path(resource['url'])
+    if not info or not path:
+        return plugins_toolkit.abort(404, plugins_toolkit._('Snapshot not available'))
+
+    if request.args.get('format') != 'json':
+        return send_file(path, mimetype='application/vnd.apache.arrow.file', conditional=True,
+                         etag=info['digest'], as_attachment=True, download_name=f'{resource_id}.arrow')
+
+    try:
+        offset = max(0, int(request.args.get('offset', 0)))
+        limit = min(SNAPSHOT_MAX_ROWS, max(0, int(request.args.get('limit', SNAPSHOT_MAX_ROWS))))
+    except ValueError:
+        return plugins_toolkit.abort(400, plugins_toolkit._('Invalid offset or limit'))
+
+    table = snapshots.load_snapshot(resource['url'])
+    if table is None:
+        return plugins_toolkit.abort(404, plugins_toolkit._('Snapshot not available'))
+
+    response = jsonify({
+        'title': info.get('title'),
+        'columns': table.column_names,
+        'total': table.num_rows,
+        'offset': offset,
+        'rows': table.slice(offset, limit).to_pylist(),
+    })
+    response.set_etag(f'{info["digest"]}-{offset}-{limit}')
+    return response.make_conditional(request)
+
+
+def latest_changes():
+    '''
+    Serves the most recently updated datasets for the homepage feed, as an
+    HTML fragment or, with `format=json`, as a compact JSON list.
+    '''
+    fmt = request.args.get('format', 'html')
+    try:
+        rows = min(LATEST_CHANGES_MAX_ROWS, max(1, int(request.args.get('rows', LATEST_CHANGES_ROWS))))
+    except ValueError:
+        return plugins_toolkit.abort(400, plugins_toolkit._('Invalid rows'))
+
+    datasets = helpers.recent_updates(rows)
+
+    versions = [(dataset['id'], dataset['metadata_modified']) for dataset in datasets]
+    etag = hashlib.sha1(json.dumps([h.lang(), fmt, versions]).encode()).hexdigest()
+
+    if fmt == 'json':
+        response = jsonify([{
+            'id': dataset['id'],
+            'name': dataset['name'],
+            'title': dataset.get('title') or dataset['name'],
+            'notes': h.markdown_extract(dataset.get('notes'), extract_length=180),
+            'url': h.url_for('dataset.read', id=dataset['name']),
+            'metadata_modified': dataset['metadata_modified'],
+            'formats': h.dict_list_reduce(dataset.get('resources', []), 'format'),
+        } for dataset in datasets])
+    else:
+        response = make_response(plugins_toolkit.render_snippet(
+            'home/snippets/recently_updated_dataset_list.html', {'datasets': datasets}))
+
+    response.set_etag(etag)
+    if datasets:
+        response.last_modified = max(h.date_str_to_datetime(dataset['metadata_modified']) for dataset in datasets)
+    response.cache_control.public = True
+    response.cache_control.max_age = LATEST_CHANGES_MAX_AGE
+    return response.make_conditional(request)
+
+
+def static_page(name):
+    '''
+    Renders one of the static pages (faq, privacy...).
+
+    For anonymous users the page is rendered once per language and process,
+    and served with a strong ETag and a public Cache-Control; logged in users
+    get a freshly rendered page, since the header shows their account.
+    Responses vary on the cookie, so that caches do not serve the anonymous
+    page after login.
+
+    Requests with a query string are rendered on the fly, since the links in
+    the page may carry its parameters.
+    '''
+    template = 'pages/{0}.html'.format(name)
+    if plugins_toolkit.c.user or session.get('_flashes') or request.args:
+        response = make_response(base.render(template))
+        response.vary.add('Cookie')
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+
+    key = (name, h.lang())
+    page = _static_pages.get(key)
+    if page is None:
+        body = base.render(template)
+        page = (hashlib.sha1(body.encode()).hexdigest(), body)
+        with _static_pages_lock:
+            _static_pages[key] = page
+
+    etag, body = page
+    response = make_response(body)
+    response.set_etag(etag)
+    response.vary.add('Cookie')
+    response.cache_control.public = True
+    response.cache_control.max_age = int(config.get(CONFIG_STATIC_PAGES_MAX_AGE, DEFAULT_STATIC_PAGES_MAX_AGE))
+    return response.make_conditional(request)